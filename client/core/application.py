@@ -4,9 +4,16 @@ from core.client.chatclientfactory import ChatClientFactory
 from core.ui.emptyframe import EmptyFrame
 from core.ui.loginframe import LoginFrame
 from core.ui.chatframe import ChatFrame
-from support.const.globals import serverInformation, defaultPalette, availableCommands
+from support.const.globals import serverInformation, defaultPalette, availableCommands, framesPerSecond, minimumSplashTime
 from support.helpers import newMessage, newCommand
 
+# The states of the connection to the server.
+STATE_DISCONNECTED  = "disconnected"
+STATE_CONNECTING    = "connecting"
+STATE_JOINING       = "joining"
+STATE_CONNECTED     = "connected"
+STATE_RECONNECTING  = "reconnecting"
+
 class Application(object):
     """
         The ChatMaster 3000 application.
@@ -16,19 +23,32 @@ class Application(object):
 
         Args:
             isConnected (bool)      :   A boolean value indicating whether the user is connected.
+            state (str)             :   The state of the connection, which moves from
+                                        disconnected to connecting, joining and connected,
+                                        and to reconnecting if the connection is lost.
             frame (obj)             :   The UI frame of the application.
             mainLoop (obj)          :   The event loop.
             clientFactory (obj)     :   The chat protocol factory.
             connector (obj)         :   A connector object.
             alamarHandler (tuple)   :   A handler for the urwid  alarm
+            frameInterval (float)   :   The shortest time between two redraws.
+            redrawHandler (tuple)   :   The alarm of the next redraw, if one
+                                        has been asked for.
+            lastDrawTime (float)    :   When the screen was last drawn.
+            splashShownAt (float)   :   When the last splash screen was shown.
     """
 
     isConnected     = False
+    state           = STATE_DISCONNECTED
     frame           = None
     mainLoop        = None
     clientFactory   = None
     connector       = None
     alarmHandler    = None
+    frameInterval   = 1.0 / framesPerSecond
+    redrawHandler   = None
+    lastDrawTime    = 0.0
+    splashShownAt   = 0.0
 
     def __init__(self):
         """
@@ -65,7 +85,7 @@ class Application(object):
         # Can't use isinstance of here, because LoginFrame and ChatFrame
         # share the same base class, which according to Python makes them the same???
         if str(self.frame.__class__) == str(LoginFrame):
-            if self.isConnected is False:
+            if self.state == STATE_DISCONNECTED:
                 self.__makeConnection(parameter)
         else:
             if parameter.startswith("/"):
@@ -82,14 +102,28 @@ class Application(object):
             Invoked when the client has established a connection.
         """
         self.isConnected = True
-        self.__setFrame(EmptyFrame(["Connection established.", "Joining server..."]))
-        time.sleep(1) # TODO: REMOVE ME
+        if self.state == STATE_RECONNECTING:
+            # The chat frame stays, until the server has been joined again.
+            return
+        self.state = STATE_JOINING
+        self.__showSplash(["Connection established.", "Joining server..."])
 
     def didJoinServer(self):
         """
             Invoked when the client has been allowed to join the server.
-        """
-        self.__transitionToFrame(ChatFrame)
+
+            Note:
+                The chat frame takes over right away, and receives the
+                messages that follow, even while the splash screen is
+                still shown for its minimum time.
+        """
+        if self.state == STATE_RECONNECTING:
+            self.state = STATE_CONNECTED
+            self.frame.printToScreen("Reconnected.", "bold-heading")
+            self.shouldUpdateScreen()
+            return
+        self.state = STATE_CONNECTED
+        self.__setFrameAfterSplash(ChatFrame(self))
         self.frame.printToScreen("Successfully connected.", "bold-heading")
         self.shouldUpdateScreen()
         self.frame.enableChatBox(True)
@@ -98,10 +132,19 @@ class Application(object):
         """
             Called when the client fails to connect to the server.
 
+            Note:
+                A connection refused at login, because the username
+                is taken, is closed.
+
             Args:
                 reason (str)    :   The reason of the failure.
         """
         self.isConnected = False
+        self.state = STATE_DISCONNECTED
+        self.clientFactory.stopTrying()
+        if self.connector is not None:
+            self.connector.disconnect()
+            self.connector = None
         self.__setFrame(EmptyFrame(["Connection failed.", "", reason], self))
         self.__transitionToFrame(LoginFrame, 2)
 
@@ -109,10 +152,25 @@ class Application(object):
         """
             Invoked when the client loses connection.
 
+            Note:
+                Once the server has been joined, the client factory
+                reconnects on its own, and the chat frame stays while
+                it does, see ChatClientFactory.
+
             Args:
                 reason (str)    :   The reason.
         """
         self.isConnected = False
+        if self.state == STATE_DISCONNECTED:
+            # Already handled, as a failed connection.
+            return
+        if self.clientFactory.continueTrying:
+            if self.state == STATE_CONNECTED:
+                self.state = STATE_RECONNECTING
+                self.frame.printToScreen("Connection lost. Reconnecting...", "bold-heading")
+                self.shouldUpdateScreen(True)
+            return
+        self.state = STATE_DISCONNECTED
         self.__setFrame(EmptyFrame(["Connection lost.", "", reason], self))
         self.__transitionToFrame(LoginFrame, 2)
 
@@ -129,17 +187,41 @@ class Application(object):
             style = "default"
 
         self.frame.printToScreen(message, style)
+        self.shouldUpdateScreen()
 
     def didReceiveNotification(self, notification):
         """
         """
         self.frame.printToScreen(notification, "bold-heading")
+        self.shouldUpdateScreen()
 
-    def shouldUpdateScreen(self):
+    def didChangeUsername(self, username):
         """
-            Redraws the screen.
+            Invoked when the server has accepted a username change.
+
+            Args:
+                username (str)  :   The new username.
         """
-        self.mainLoop.draw_screen()
+        self.clientFactory.setUsername(username)
+
+    def shouldUpdateScreen(self, immediately=False):
+        """
+            Asks for the screen to be redrawn.
+
+            Note:
+                The requests are coalesced, and the screen is drawn at
+                most once per frame interval, however many messages
+                arrive in between. Changes made by the user, such as
+                a frame switch or a sent message, are drawn right away.
+
+            Args:
+                immediately (bool)  :   Whether to draw right away.
+        """
+        if immediately:
+            self.__drawScreen()
+        elif self.redrawHandler is None:
+            delay = self.lastDrawTime + self.frameInterval - time.time()
+            self.redrawHandler = self.mainLoop.set_alarm_in(max(delay, 0), self.__didReachRedrawTime)
 
     def shouldUpdateChannelList(self, channels=None, title="Channels:"):
         """
@@ -164,9 +246,10 @@ class Application(object):
                 the alarm.
         """
         if self.alarmHandler is not None:
-            self.alarmHandler.func()
-            self.mainLoop.remove_alarm(self.alarmHandler)
+            alarmHandler = self.alarmHandler
             self.alarmHandler = None
+            alarmHandler.func()
+            self.mainLoop.remove_alarm(alarmHandler)
 
     ##########################
     #   Semi-private methods
@@ -177,15 +260,40 @@ class Application(object):
         """
         self.clientFactory = ChatClientFactory(self)
 
-    def __makeConnection(self, username):
+    def __makeConnection(self, username=None):
         """
             Attempts to connect to the server.
+
+            Note:
+                Nothing waits for the connection. The client calls
+                didConnect() once it is made, or didFailConnection().
+
+            Args:
+                username (str)  :   The username, or None to use the last one.
         """
-        self.__setFrame(EmptyFrame(["Connecting..."]))
-        time.sleep(1) # TODO: REMOVE ME
-        self.clientFactory.setUsername(username)
+        self.state = STATE_CONNECTING
+        self.__showSplash(["Connecting..."])
+        if username is not None:
+            self.clientFactory.setUsername(username)
         self.connector = reactor.connectTCP(serverInformation["addr"], serverInformation["port"], self.clientFactory)
 
+    def __drawScreen(self):
+        """
+            Draws the screen, dropping a redraw asked for.
+        """
+        if self.redrawHandler is not None:
+            self.mainLoop.remove_alarm(self.redrawHandler)
+            self.redrawHandler = None
+        self.lastDrawTime = time.time()
+        self.mainLoop.draw_screen()
+
+    def __didReachRedrawTime(self, loop=None, user_data=None):
+        """
+            Draws the screen, once the frame interval has passed.
+        """
+        self.redrawHandler = None
+        self.__drawScreen()
+
     def __sendMessage(self, message):
         """
             Send a message to the server.
@@ -193,11 +301,12 @@ class Application(object):
             Args:
                 message (str)   :   The message to send.
         """
-        if self.isConnected or self.connector is not None:
-            package = newMessage(message)
+        if self.state == STATE_CONNECTED:
+            package = newMessage(message, self.clientFactory.codec)
             text = "%s: %s" % (self.clientFactory.username, message)
             self.frame.printToScreen(text)
-            self.connector.transport.write(package)
+            self.shouldUpdateScreen(True)
+            self.clientFactory.sendPackage(package)
         else:
             self.frame.printErrorMessage("You must be connected.")
 
@@ -217,14 +326,61 @@ class Application(object):
                 newFrame (obj)                  :   The frame to transition to.
                 transitionInSeconds (float)     :   Number of seconds before transition
         """
+        self.__cancelTransition()
         if transitionInSeconds > 0:
             def exitFrame(loop=None, user_data=None):
+                self.alarmHandler = None
                 self.__setFrame(newFrame(self))
             # Set an alarm with the above exitFrame(loop:user_data:) function as the callback.
             self.alarmHandler = self.mainLoop.set_alarm_in(transitionInSeconds, exitFrame)
         else:
             self.__setFrame(newFrame(self))
 
+    def __showSplash(self, lines):
+        """
+            Shows a splash screen, for at least minimumSplashTime seconds
+            if followed by __setFrameAfterSplash().
+
+            Args:
+                lines (list)    :   The lines of text to show.
+        """
+        self.__cancelTransition()
+        self.__setFrame(EmptyFrame(lines, self))
+        self.splashShownAt = time.time()
+
+    def __setFrameAfterSplash(self, newFrame):
+        """
+            Sets the window frame, once the splash screen has been shown
+            for its minimum time.
+
+            Note:
+                The new frame becomes the frame of the application right
+                away. Only showing it may wait, with an alarm, which a
+                keystroke skips.
+
+            Args:
+                newFrame (obj)  :   The new frame.
+        """
+        self.__cancelTransition()
+        remaining = self.splashShownAt + minimumSplashTime - time.time()
+        if remaining <= 0:
+            self.__setFrame(newFrame)
+            return
+
+        def showFrame(loop=None, user_data=None):
+            self.alarmHandler = None
+            self.__setFrame(newFrame)
+        self.frame = newFrame
+        self.alarmHandler = self.mainLoop.set_alarm_in(remaining, showFrame)
+
+    def __cancelTransition(self):
+        """
+            Cancels a pending frame transition, if any.
+        """
+        if self.alarmHandler is not None:
+            self.mainLoop.remove_alarm(self.alarmHandler)
+            self.alarmHandler = None
+
     def __setFrame(self, newFrame):
         """
             Sets the window frame.
@@ -238,7 +394,7 @@ class Application(object):
         lastUsedFrame = self.mainLoop.widget.base_widget
         self.mainLoop.widget = newFrame
         self.frame = newFrame
-        self.shouldUpdateScreen()
+        self.shouldUpdateScreen(True)
 
         del(lastUsedFrame) # Try to release it
         # NOTE: Problem with reference cycles
@@ -286,17 +442,22 @@ class Application(object):
 
             If already connected, alert the user.
         """
-        if self.isConnected:
+        if self.state == STATE_RECONNECTING:
+            self.frame.printErrorMessage("Reconnecting. Please use /disconnect first.")
+        elif self.isConnected:
             self.frame.printErrorMessage("Connection already established. Please use /disconnect first.")
         else:
             self.__makeConnection()
 
     def __executeCommandDisconnect(self, parameter=None):
         """
-            Disconnect from the server.
+            Disconnect from the server, or stop reconnecting.
         """
+        self.clientFactory.stopTrying()
         if self.isConnected and self.connector is not None:
             self.connector.disconnect()
+        elif self.state == STATE_RECONNECTING:
+            self.didFailConnection("Stopped reconnecting.")
         else:
             self.frame.printErrorMessage("Not connected.")
 
@@ -309,8 +470,8 @@ class Application(object):
         """
         if parameter is None or not len(parameter) > 0:
             return
-        data = newCommand("rename", {"username": parameter[0]})
-        self.connector.transport.write(data)
+        data = newCommand("rename", {"username": parameter[0]}, codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandJoin(self, parameter=None):
         """
@@ -322,36 +483,60 @@ class Application(object):
         if parameter is None or not len(parameter) > 0:
             return
 
-        data = newCommand("join", {"channel": parameter[0]})
-        self.connector.transport.write(data)
+        data = newCommand("join", {"channel": parameter[0]}, codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandLeave(self, parameter=None):
         """
             Leaves a channel.
         """
-        data = newCommand("leave")
-        self.connector.transport.write(data)
+        self.clientFactory.forgetChannel()
+        data = newCommand("leave", codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandChannels(self, parameter=None):
         """
             Update the channels list.
         """
-        data = newCommand("channel_list")
-        self.connector.transport.write(data)
+        data = newCommand("channel_list", codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
+
+    def __executeCommandUsers(self, parameter=None):
+        """
+            Requests the full list of users in the current channel.
+        """
+        data = newCommand("users", codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
+
+    def __executeCommandHistory(self, parameter=None):
+        """
+            Requests earlier messages of the current channel.
+
+            Args:
+                parameter (str) :   The number of messages, optional.
+        """
+        parameters = {}
+        if parameter is not None and len(parameter) > 0:
+            if not parameter[0].isdigit():
+                self.frame.printErrorMessage("Usage: /history [count]")
+                return
+            parameters["count"] = int(parameter[0])
+        data = newCommand("history", parameters, codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandPrivate(self, parameter=None):
         """
             Set a channel to private.
         """
-        data = newCommand("private")
-        self.connector.transport.write(data)
+        data = newCommand("private", codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandPublic(self, parameter=None):
         """
             Set a channel to public.
         """
-        data = newCommand("public")
-        self.connector.transport.write(data)
+        data = newCommand("public", codec=self.clientFactory.codec)
+        self.clientFactory.sendPackage(data)
 
     def __executeCommandHelp(self, parameter=None):
         text = "ChatMaster 3000 commands:\n"
@@ -360,6 +545,8 @@ class Application(object):
         text += "/rename [username] - change username\n"
         text += "/join [channel] - join or create a channel\n"
         text += "/leave - leave the current channel\n"
+        text += "/history [count] - show earlier messages of the channel\n"
+        text += "/users - refresh the users list of the channel\n"
         text += "/public - set the current channel to public\n"
         text += "/private - set the current channel to private\n"
         text += "/exit - quit the program\n"
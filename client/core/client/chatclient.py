@@ -1,6 +1,8 @@
-import json
 from twisted.internet import protocol
-from support.helpers import newCommand
+from support.helpers import newPackage, newCommand
+from shared.framing import FrameBuffer, FramingError, FRAMING_MODES, FRAMING_NEWLINE, FRAMING_LENGTH, negotiateFraming
+from shared.compression import StreamCompressor, CompressionError, COMPRESSION_METHODS
+from shared.codec import CODEC_NAMES, getCodec, decodePackage
 
 class ChatClient(protocol.Protocol):
     """
@@ -11,10 +13,25 @@ class ChatClient(protocol.Protocol):
 
         Args:
             delegate (obj)  :   The delegate of the client.
+            frameBuffer (obj):  The buffer splitting the stream into packages.
+            compressor (obj) :  The stream compressor, once negotiated.
+            codec (obj)     :   The codec packages are sent with.
+            channel (str)   :   The channel whose users are kept.
+            members (set)   :   The users inside the channel.
+            seen (int)      :   The sequence number of the last message
+                                of the channel received.
+            factory (obj)   :   The factory that made the client.
     """
 
     delegate = None
+    factory = None
     username = None
+    frameBuffer = None
+    compressor = None
+    codec = None
+    channel = None
+    members = None
+    seen = 0
 
     def __init__(self, username=None, delegate=None):
         """
@@ -25,6 +42,9 @@ class ChatClient(protocol.Protocol):
         """
         self.username = username
         self.delegate = delegate
+        self.frameBuffer = FrameBuffer()
+        self.codec = getCodec()
+        self.members = set()
 
     def connectionMade(self):
         """
@@ -55,16 +75,48 @@ class ChatClient(protocol.Protocol):
             Args:
                 data (str) : The data received.
         """
-        package = json.loads(data)
-        if "type" not in package:
+        self.frameBuffer.feed(data)
+        try:
+            for frame in self.frameBuffer.frames():
+                if self.compressor is not None:
+                    frame = self.compressor.decompress(frame)
+                try:
+                    package = decodePackage(frame)
+                except ValueError:
+                    continue
+                self.packageReceived(package)
+        except (FramingError, CompressionError):
+            self.transport.loseConnection()
+
+    def packageReceived(self, package):
+        """
+            Invoked for every complete package received.
+
+            Args:
+                package (dict) : The package received.
+        """
+        if not isinstance(package, dict) or not isinstance(package.get("type"), basestring):
             return
         # Use the type attribute to find the right handler method
         methodName = package["type"].capitalize()
         methodCall = getattr(self, "_"+self.__class__.__name__+"__handle"+methodName, None)
         data = package.get("data", None)
+        if data is not None and not isinstance(data, dict):
+            return
         if methodCall is not None:
             methodCall(data)
 
+    def sendPackage(self, package):
+        """
+            Frames and sends an encoded package.
+
+            Args:
+                package (str) : The encoded package.
+        """
+        if self.compressor is not None:
+            package = self.compressor.compress(package)
+        self.transport.write(self.frameBuffer.encode(package))
+
     def __handleMessage(self, package=None):
         """
             Handles messages sent from other users.
@@ -75,6 +127,9 @@ class ChatClient(protocol.Protocol):
         if package is None:
             return
 
+        seq = package.get("seq")
+        if isinstance(seq, int) and seq > self.seen:
+            self.seen = seq
         text = "%s: %s" % (package["username"], package["message"])
         self.delegate.didReceiveMessage(text)
 
@@ -86,13 +141,31 @@ class ChatClient(protocol.Protocol):
                 package (dict)  :   The message.
         """
         requestType = package["request"]
-        response = None
         if requestType == "login":
-            # On requests of type login, the client
-            # should send back the username.
-            response = newCommand("login", {"username": self.username})
-        if response is not None:
-            self.transport.write(response)
+            # On requests of type login, the client should send back the
+            # username, along with the preferred framing mode out of those
+            # offered. The login itself is still newline framed, and the
+            # new mode applies to everything after it. Compression and the
+            # binary codec are only offered on length prefixed connections.
+            # When reconnecting, the token of the lost session is sent too,
+            # with the sequence number of the last message received.
+            framing = negotiateFraming(FRAMING_MODES, package.get("framing", [FRAMING_NEWLINE]))
+            parameters = {"username": self.username, "framing": framing}
+            if self.factory is not None and self.factory.resumeToken is not None:
+                parameters["resume"] = self.factory.resumeToken
+                parameters["seen"] = self.factory.seen
+            if framing == FRAMING_LENGTH:
+                parameters["compression"] = COMPRESSION_METHODS
+                parameters["codecs"] = CODEC_NAMES
+            self.sendPackage(newCommand("login", parameters))
+            self.frameBuffer.setMode(framing)
+
+    def __handlePing(self, package=None):
+        """
+            Answers a ping from the server, which drops connections
+            that stay silent.
+        """
+        self.sendPackage(newPackage("pong", package or {}, self.codec))
 
     def __handleSession(self, package=None):
         """
@@ -105,8 +178,20 @@ class ChatClient(protocol.Protocol):
             return
 
         if package["status"] is True:
+            # The server compresses and encodes everything after the
+            # session package with what was negotiated.
+            if package.get("compression") is not None:
+                self.compressor = StreamCompressor()
+            if package.get("codec") is not None:
+                self.codec = getCodec(package["codec"])
+            if self.factory is not None:
+                self.factory.didJoinServer()
             self.delegate.didJoinServer()
             self.delegate.shouldUpdateChannelList(package["channels"])
+        elif self.factory is not None and self.factory.shouldRetryLogin():
+            # While reconnecting, the username may still be held by the
+            # lost connection, on another worker, until it is reaped.
+            self.transport.loseConnection()
         else:
             self.delegate.didFailConnection(package["reason"])
 
@@ -124,33 +209,93 @@ class ChatClient(protocol.Protocol):
             channels = package["parameters"]["channels"]
             if channels is not None: # Prevent an infinite loop if something goes wrong
                 self.delegate.shouldUpdateChannelList(channels)
-        elif eventType == "user_joined":
-            notification = "User %s has joined the channel %s." % (package["parameters"]["username"], package["parameters"]["channel"])
-            channelName = "%s:" % package["parameters"]["channel"]
-            self.delegate.shouldUpdateChannelList(package["parameters"]["current_users"], channelName)
-        elif eventType == "user_left":
-            username = package["parameters"]["username"]
-            channelName = package["parameters"]["channel"]
-            allUsers = package["parameters"]["current_users"]
-            notification = "User %s left the channel %s." % (username, channelName)
-            # If it regards the current client, then the shouldUpdateChannelList method
-            # should be called without any parameters.
-            if username == self.username:
-                allUsers = None
-                channelName = None
-
-            self.delegate.shouldUpdateChannelList(allUsers, channelName)
+        elif eventType == "user_list":
+            # A full snapshot, sent after joining a channel.
+            self.channel = package["parameters"]["channel"]
+            self.members = set(package["parameters"]["current_users"])
+            self.seen = package["parameters"].get("seq", 0)
+            self.__updateMemberList()
+        elif eventType == "presence":
+            self.__applyPresence(package["parameters"])
         elif eventType == "user_rename":
-            notification = "User %s changed nickname to %s" % (package["old_username"], package["new_username"])
+            oldUsername = package["parameters"]["old_username"]
+            newUsername = package["parameters"]["new_username"]
+            notification = "User %s changed nickname to %s" % (oldUsername, newUsername)
+            if oldUsername == self.username:
+                self.username = newUsername
+                self.delegate.didChangeUsername(newUsername)
+        elif eventType == "channel_visibility":
+            parameters = package["parameters"]
+            visibility = "public" if parameters["public"] else "private"
+            notification = "User %s set the channel %s to %s." % (parameters["username"], parameters["channel"], visibility)
+        elif eventType == "resume":
+            self.__resumeSession(package["parameters"])
 
         if notification is not None:
             self.delegate.didReceiveNotification(notification)
 
+    def __applyPresence(self, parameters):
+        """
+            Applies the changes of a presence notification to the
+            members of the current channel.
+
+            Args:
+                parameters (dict) : The added, removed and renamed users.
+        """
+        channel = parameters["channel"]
+        if channel != self.channel:
+            return
+        notifications = []
+        for username in parameters["removed"]:
+            self.members.discard(username)
+            notifications.append("User %s left the channel %s." % (username, channel))
+        for rename in parameters["renamed"]:
+            oldUsername = rename["old_username"]
+            newUsername = rename["new_username"]
+            self.members.discard(oldUsername)
+            self.members.add(newUsername)
+            # The renamed user has already been told by a user_rename notification.
+            if newUsername != self.username:
+                notifications.append("User %s changed nickname to %s" % (oldUsername, newUsername))
+        for username in parameters["added"]:
+            self.members.add(username)
+            notifications.append("User %s has joined the channel %s." % (username, channel))
+
+        self.__updateMemberList()
+        for notification in notifications:
+            self.delegate.didReceiveNotification(notification)
+
+    def __resumeSession(self, parameters):
+        """
+            Keeps the token of the session, and joins the channel the
+            user was in again, unless the server resumed the session.
+
+            Note:
+                A session can not be resumed once it has expired, or on
+                another server, which is when the client joins itself.
+
+            Args:
+                parameters (dict) : The token, and whether the session was resumed.
+        """
+        if self.factory is None:
+            return
+        self.factory.resumeToken = parameters["token"]
+        channel = self.factory.channel
+        self.factory.channel = None
+        if channel is not None and not parameters["resumed"]:
+            self.sendPackage(newCommand("join", {"channel": channel}, self.codec))
+
+    def __updateMemberList(self):
+        """
+            Shows the members of the current channel.
+        """
+        self.delegate.shouldUpdateChannelList(sorted(self.members), "%s:" % self.channel)
+
     def __handleError(self, package):
         """
             Handles errors from the server
         """
         errorType = package["error_type"]
-        # No other error types implemented so far besides leave and join.
-        if errorType == "join" or errorType == "leave":
+        # No other error types implemented so far besides leave, join, rename, history, users, message, private and public.
+        if errorType in ("join", "leave", "rename", "history", "users", "message", "private", "public"):
             self.delegate.didReceiveNotification(package["message"])
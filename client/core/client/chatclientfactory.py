@@ -1,21 +1,51 @@
 from twisted.internet import protocol
+import time
 from core.client.chatclient import ChatClient
 
-class ChatClientFactory(protocol.ClientFactory):
+class ChatClientFactory(protocol.ReconnectingClientFactory):
     """
         The ChatMaster 3000 Client Factory.
 
         This class is will be generating new instances of the ChatMaster
         3000 client protocol, that will be responsible for handling the
         actual communication between the server and the user.
+
+        Once the user has joined the server, a lost connection is made
+        again, waiting a jittered, exponentially growing delay between
+        the attempts, so that clients dropped together do not all come
+        back at once. The new connection resumes the session, see
+        ChatClient.
+
+        Note:
+            A login refused while reconnecting is tried again for up to
+            loginRetryTime seconds, as the lost connection may hold the
+            username until the server notices it is gone.
+
+        Args:
+            resumeToken (str)   :   The token to resume the session with.
+            channel (str)       :   The channel the user was in when the
+                                    connection was lost.
+            seen (int)          :   The sequence number of the last message
+                                    received in the channel.
+            lostAt (float)      :   When the connection was lost, while
+                                    reconnecting.
     """
 
     protocol = ChatClient
     delegate = None
     username = None
+    client = None
+    resumeToken = None
+    channel = None
+    seen = 0
+    lostAt = None
+    maxDelay = 30
+    loginRetryTime = 90.0
 
     def __init__(self, delegate=None):
         self.delegate = delegate
+        # Only reconnect once the user has joined, see didJoinServer().
+        self.continueTrying = False
 
     def setUsername(self, username):
         self.username = username
@@ -28,10 +58,85 @@ class ChatClientFactory(protocol.ClientFactory):
             Returns:
                 An instance of the chat client protocol.
         """
-        return self.protocol(self.username, self.delegate)
+        self.client = self.protocol(self.username, self.delegate)
+        self.client.factory = self
+        return self.client
+
+    def didJoinServer(self):
+        """
+            Called when the user has joined the server, from then on
+            reconnecting when the connection is lost.
+        """
+        self.resetDelay()
+        self.lostAt = None
+
+    def shouldRetryLogin(self):
+        """
+            Returns:
+                True if a refused login should be tried again.
+        """
+        return bool(self.continueTrying) and self.lostAt is not None and time.time() - self.lostAt < self.loginRetryTime
+
+    def forgetChannel(self):
+        """
+            Forgets the channel of the user, once it has been left.
+        """
+        self.channel = None
+        if self.client is not None:
+            self.client.channel = None
+
+    @property
+    def codec(self):
+        """
+            The codec packages must be encoded with, or None before
+            connecting, meaning JSON.
+        """
+        if self.client is None:
+            return None
+        return self.client.codec
+
+    def sendPackage(self, package):
+        """
+            Sends a package through the current connection.
+
+            Args:
+                package (str)   :   The encoded package.
+        """
+        if self.client is not None:
+            self.client.sendPackage(package)
+
+    def stopTrying(self):
+        """
+            Stops reconnecting, and forgets the session.
+        """
+        protocol.ReconnectingClientFactory.stopTrying(self)
+        self.resumeToken = None
+        self.channel = None
+        self.seen = 0
+        self.lostAt = None
+
+    def clientConnectionLost(self, connector, reason):
+        """
+            Called when an established connection has been lost.
+
+            Note:
+                The delegate has already been told by the client.
+        """
+        if self.client is not None and self.client.channel is not None:
+            self.channel = self.client.channel
+            self.seen = self.client.seen
+        if self.lostAt is None:
+            self.lostAt = time.time()
+        self.client = None
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         """
-            Called when the connection has failed.
+            Called when the connection has failed, trying again if
+            reconnecting.
         """
-        self.delegate.didFailConnection(reason.getErrorMessage())
+        self.client = None
+        if self.continueTrying:
+            protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+        else:
+            self.delegate.didFailConnection(reason.getErrorMessage())
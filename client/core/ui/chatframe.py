@@ -5,7 +5,7 @@ from core.ui.components.chatwindow import ChatWindow
 from core.ui.components.channellist import ChannelList
 from core.ui.components.chatbox import ChatBox
 from core.ui.components.titlebar import TitleBar
-from support.const.globals import defaultPalette
+from support.const.globals import defaultPalette, chatLogScrollback
 from support.clock import Clock
 
 class ChatFrame(BasicFrame):
@@ -26,7 +26,7 @@ class ChatFrame(BasicFrame):
         # The actual title bar. The title has a relative width, while clock has a set width of 5 columns wide.
         self.titleBar = ColumnView([('weight', 1, titleBar), (5, clock)])
 
-        self.chatLog = ChatWindow()
+        self.chatLog = ChatWindow(chatLogScrollback)
         self.chatBox = ChatBox("> ", self)
         # Create the channel list and set its label
         self.channelList = ChannelList()
@@ -68,13 +68,7 @@ class ChatFrame(BasicFrame):
                 text    (string)   : The text to print out.
                 style   (string)   : The style of the text.
         """
-        time = Clock.localTime()
-        time = "%s:%s" % (time.hour, time.minutes)
-        message = "[%s] %s" % (time, message)
-        textWidget = urwid.Text((style, message))
-        currentRow = self.__numberOfRows()
-        self.chatLog.body.insert(currentRow, textWidget)
-        self.chatLog.focus_position = currentRow
+        self.chatLog.append(Clock.timestamp(), message, style)
 
     def printErrorMessage(self, errorMessage, style="bold-heading"):
         """
@@ -85,13 +79,13 @@ class ChatFrame(BasicFrame):
                 style (str)         : The style.
         """
         self.printToScreen("Error: %s" % errorMessage, style)
-        self.delegate.shouldUpdateScreen()
+        self.delegate.shouldUpdateScreen(True)
 
     def clearChatLog(self):
         """
             Clears the chat log.
         """
-        self.chatLog.body[:] = []
+        self.chatLog.clear()
 
     def enableChatBox(self, mode):
         """
@@ -134,14 +128,3 @@ class ChatFrame(BasicFrame):
         for channel in channels:
             self.channelList.body.append(urwid.Text(("channelList-text", channel)))
         self.delegate.shouldUpdateScreen()
-
-    ##########################
-    #   Semi-private methods
-    ##########################
-
-    def __numberOfRows(self):
-        """
-            Returns:
-                The number of rows in the chat log.
-        """
-        return len(self.chatLog.body)
@@ -1,7 +1,7 @@
 import urwid
-from core.ui.components.chatwindow import ChatWindow
+from core.ui.components.wrapper import Wrapper
 
-class ChannelList(ChatWindow):
+class ChannelList(urwid.ListBox, Wrapper):
     """
         Represents the channel list to the left.
 
@@ -9,4 +9,7 @@ class ChannelList(ChatWindow):
             Despite the name, the channel list will also consist of
             all the users in a specific room.
     """
-    pass
+
+    def __init__(self):
+        body = urwid.SimpleFocusListWalker([])
+        super(ChannelList, self).__init__(body)
@@ -1,14 +1,147 @@
 import urwid
 from core.ui.components.wrapper import Wrapper
 
+class ChatLogWalker(urwid.ListWalker):
+    """
+        A list walker over the lines of the chat log.
+
+        The lines are kept as plain (timestamp, style, text) tuples in a
+        ring buffer of at most limit lines, dropping the oldest first.
+        Text widgets are only made for the lines urwid asks for, which
+        are the ones on screen, so scrolling and drawing cost the same
+        however long the scrollback is.
+
+        Note:
+            The position of a line is its number since the log was last
+            cleared, and is kept in the slot position % limit of the
+            ring buffer. Positions stay valid as older lines are dropped.
+
+        Args:
+            limit (int)     :   The most lines kept.
+            lines (list)    :   The ring buffer of lines.
+            end (int)       :   The position after the last line.
+            focus (int)     :   The position of the focused line.
+            widgets (dict)  :   The text widgets made, keyed by position.
+    """
+
+    limit = 1000
+    # The most text widgets kept around, a few screens' worth.
+    widgetCacheSize = 256
+
+    def __init__(self, limit=None):
+        if limit is not None:
+            self.limit = limit
+        self.lines = []
+        self.end = 0
+        self.focus = 0
+        self.widgets = {}
+
+    def __len__(self):
+        return self.end - self.start()
+
+    def __getitem__(self, position):
+        """
+            Returns the text widget of a line, making it if needed.
+
+            Raises:
+                IndexError, if there is no line at the position.
+        """
+        if not self.start() <= position < self.end:
+            raise IndexError(position)
+        widget = self.widgets.get(position)
+        if widget is None:
+            if len(self.widgets) >= self.widgetCacheSize:
+                self.widgets.clear()
+            timestamp, style, text = self.lines[position % self.limit]
+            widget = self.widgets[position] = urwid.Text((style, "[%s] %s" % (timestamp, text)))
+        return widget
+
+    def start(self):
+        """
+            Returns:
+                The position of the oldest line kept.
+        """
+        return max(0, self.end - self.limit)
+
+    def append(self, timestamp, style, text):
+        """
+            Adds a line at the end of the log.
+
+            Note:
+                The focus follows the new line, unless the user has
+                scrolled back, or the focused line was dropped.
+
+            Args:
+                timestamp (str) :   The time the line was printed.
+                style (str)     :   The style of the text.
+                text (str)      :   The text.
+        """
+        following = self.focus >= self.end - 1
+        line = (timestamp, style, text)
+        if len(self.lines) < self.limit:
+            self.lines.append(line)
+        else:
+            self.lines[self.end % self.limit] = line
+            self.widgets.pop(self.end - self.limit, None)
+        self.end += 1
+        if following or self.focus < self.start():
+            self.focus = self.end - 1
+        self._modified()
+
+    def clear(self):
+        """
+            Drops every line.
+        """
+        self.lines = []
+        self.end = 0
+        self.focus = 0
+        self.widgets = {}
+        self._modified()
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def next_position(self, position):
+        return position + 1
+
+    def prev_position(self, position):
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(self.end - 1, self.start() - 1, -1)
+        return range(self.start(), self.end)
+
 class ChatWindow(urwid.ListBox, Wrapper):
     """
         A ListBox urwid widget representing the chat log of the application.
 
         All messages to the user will be displayed in the chat window.
-        The ListBox's content will consist only of a list walker widget.
+        The ListBox's content will consist only of a list walker widget,
+        keeping at most limit lines, see ChatLogWalker.
+
+        Args:
+            limit (int) :   The most lines kept in the chat log.
     """
 
-    def __init__(self):
-        body = urwid.SimpleFocusListWalker([])
+    def __init__(self, limit=None):
+        body = ChatLogWalker(limit)
         super(ChatWindow, self).__init__(body)
+
+    def append(self, timestamp, text, style="default"):
+        """
+            Adds a line at the end of the chat log.
+
+            Args:
+                timestamp (str) :   The time the line was printed.
+                text (str)      :   The text.
+                style (str)     :   The style of the text.
+        """
+        self.body.append(timestamp, style, text)
+
+    def clear(self):
+        """
+            Clears the chat log.
+        """
+        self.body.clear()
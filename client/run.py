@@ -1,3 +1,7 @@
+import os, sys
+# The modules shared by the server and the client live in the shared
+# folder, next to this one.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from core.application import Application
 
 if __name__ == "__main__":
@@ -1,34 +1,52 @@
 import urwid, time
 from twisted.internet import task
-from collections import namedtuple
 
 class Clock(urwid.Text):
+    """
+        A clock widget, showing the local time as HH:MM.
+
+        Note:
+            The time is formatted at most once a minute, see timestamp(),
+            and the screen is only redrawn when the text shown changes.
+
+        Args:
+            delegate (obj)  :   The delegate, asked to redraw the screen.
+    """
+
+    # The cached HH:MM text, and the time it is valid until.
+    cachedTimestamp = None
+    cachedUntil     = 0.0
 
     def __init__(self, delegate, align="left"):
         self.delegate = delegate
-        super(Clock, self).__init__("00:00", align=align)
+        super(Clock, self).__init__(Clock.timestamp(), align=align)
         l = task.LoopingCall(self.start)
         l.start(1.0) # call every second
 
     def start(self):
-        time = Clock.localTime()
-        if ":" in self.text:
-            delimiter = " "
-        else:
-            delimiter = ":"
-
-        self.set_text("%s%s%s" % (time.hour, delimiter, time.minutes))
-        self.delegate.shouldUpdateScreen()
+        timestamp = Clock.timestamp()
+        if timestamp != self.text:
+            self.set_text(timestamp)
+            self.delegate.shouldUpdateScreen()
 
     @classmethod
-    def localTime(cls):
+    def timestamp(cls):
         """
+            Returns the local time as HH:MM.
+
+            Note:
+                The text is formatted once per minute, and handed out
+                from the cache until the minute is over, which keeps
+                the timestamp of every line printed cheap. Time zone
+                offsets are whole minutes, so local minutes start with
+                the minutes since the epoch.
+
+            Returns:
+                The local time, as text.
         """
-        timeStruct = time.localtime()
-        # A value below 10 will not include the leading 0.
-        hour = str(timeStruct.tm_hour) if timeStruct.tm_hour >= 10 else "0" + str(timeStruct.tm_hour)
-        minutes = str(timeStruct.tm_min) if timeStruct.tm_min >= 10 else "0" + str(timeStruct.tm_min)
-        seconds = str(timeStruct.tm_sec) if timeStruct.tm_sec >= 10 else "0" + str(timeStruct.tm_sec)
-        LocalTime = namedtuple("localTime", "hour minutes seconds")
-
-        return LocalTime(hour=hour, minutes=minutes, seconds=seconds)
+        now = time.time()
+        if cls.cachedTimestamp is None or not cls.cachedUntil - 60 <= now < cls.cachedUntil:
+            timeStruct = time.localtime(now)
+            cls.cachedTimestamp = "%02d:%02d" % (timeStruct.tm_hour, timeStruct.tm_min)
+            cls.cachedUntil = now - now % 60 + 60
+        return cls.cachedTimestamp
@@ -15,6 +15,15 @@ defaultPalette = [
 
 serverInformation = dict(addr="localhost", port=9000)
 
+# The most lines kept in the chat log, older ones are dropped
+chatLogScrollback = 5000
+
+# The most times per second the screen is redrawn
+framesPerSecond = 30
+
+# The shortest time, in seconds, a splash screen is shown while connecting
+minimumSplashTime = 0.0
+
 availableCommands = [
     "exit", "help", "rename", "connect", "disconnect", "clear"
 ]
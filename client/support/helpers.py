@@ -1,28 +1,27 @@
+from shared.codec import getCodec
 
-def createJSONPackage(data):
+def newPackage(packageType, data, codec=None):
     """
-        Returns a JSON package.
+        Returns an encoded package.
 
         Args:
-            data (dict) :   A dictionary consisting of the data to JSONify.
+            packageType (str)   :   The package type.
+            data (dict)         :   The data attribute of the package.
+            codec (obj)         :   The codec to encode with, JSON by default.
     """
-    import json
-    return json.dumps(data)
-
-def newPackage(packageType, data):
-    """
-    """
-    return createJSONPackage({
+    if codec is None:
+        codec = getCodec()
+    return codec.encode({
         "type": packageType,
         "data": data
     })
 
-def newMessage(message):
+def newMessage(message, codec=None):
     """
     """
-    return newPackage("message", {"message": message})
+    return newPackage("message", {"message": message}, codec)
 
-def newCommand(command, parameters=None):
+def newCommand(command, parameters=None, codec=None):
     """
     """
-    return newPackage("command", {"command": command, "parameters": parameters})
+    return newPackage("command", {"command": command, "parameters": parameters}, codec)
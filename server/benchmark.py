@@ -0,0 +1,425 @@
+"""
+    Load generator and benchmark for the ChatMaster 3000 server.
+
+    Spawns simulated clients speaking PROTOCOL.md, runs one of the fixed
+    scenarios below, and reports the throughput and the fan-out latency
+    of the messages, along with the CPU time and memory used.
+
+        huge-room   :   Every bot joins one room, and the senders talk in it.
+        small-rooms :   The bots are spread over rooms of --room-size users.
+        churn       :   As small-rooms, while the bots that are not
+                        sending keep leaving and joining rooms.
+
+    Usage:
+        $ python benchmark.py huge-room --bots 2000 --senders 20 --rate 500
+        $ python benchmark.py small-rooms --bots 5000 --processes 4 --port 9000
+        $ python benchmark.py huge-room --codec binary  (needs msgpack)
+
+    Without --port, a server is started inside the benchmark process.
+    A separate server must be started without rate limits, with
+    --message-rate 0 --channel-message-rate 0.
+    Thousands of bots may need a higher limit on open files (ulimit -n).
+"""
+import argparse, json, os, random, resource, subprocess, sys, time
+# The modules shared by the server and the client live in the shared
+# folder, next to this one.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ClientFactory, Protocol
+from shared.framing import FrameBuffer, FramingError, FRAMING_MODES, negotiateFraming
+from shared.codec import CODEC_NAMES, getCodec, decodePackage
+
+SCENARIOS = ["huge-room", "small-rooms", "churn"]
+
+class LatencySamples(object):
+    """
+        A fixed size, uniform random sample of latencies.
+
+        Note:
+            Reservoir sampling keeps memory flat no matter how many
+            messages are delivered, while the percentiles stay accurate.
+
+        Args:
+            size (int)      :   The number of samples kept.
+            count (int)     :   The number of latencies seen.
+    """
+
+    size = 20000
+
+    def __init__(self):
+        self.samples = []
+        self.count = 0
+
+    def add(self, latency):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(latency)
+        else:
+            position = random.randint(0, self.count - 1)
+            if position < self.size:
+                self.samples[position] = latency
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Bot(Protocol):
+    """
+        A simulated client.
+
+        Logs in with length prefixed framing and the codec asked for,
+        joins its room and records the latency of every benchmark
+        message it receives.
+    """
+
+    def __init__(self, runner, username, channel):
+        self.runner = runner
+        self.username = username
+        self.channel = channel
+        self.frameBuffer = FrameBuffer()
+        self.codec = getCodec()
+        self.ready = False
+
+    def connectionLost(self, reason):
+        self.runner.didLoseBot(self)
+
+    def dataReceived(self, data):
+        if self.runner.measuring:
+            self.runner.bytesReceived += len(data)
+        self.frameBuffer.feed(data)
+        try:
+            for frame in self.frameBuffer.frames():
+                self.packageReceived(decodePackage(frame))
+        except (FramingError, ValueError):
+            self.transport.loseConnection()
+
+    def packageReceived(self, package):
+        packageType = package.get("type")
+        data = package.get("data") or {}
+        if packageType == "message":
+            text = data.get("message", "")
+            if text.startswith("bench:"):
+                self.runner.didReceiveMessage(float(text.split(":")[1]))
+        elif packageType == "request" and data.get("request") == "login":
+            framing = negotiateFraming(FRAMING_MODES, data.get("framing", []))
+            parameters = {"username": self.username, "framing": framing, "codecs": [self.runner.options.codec]}
+            self.sendPackage({"type": "command", "data": {"command": "login", "parameters": parameters}})
+            self.frameBuffer.setMode(framing)
+        elif packageType == "ping":
+            self.sendPackage({"type": "pong", "data": data})
+        elif packageType == "session":
+            if data.get("status"):
+                self.codec = getCodec(data.get("codec") or "json")
+                self.join(self.channel)
+            else:
+                self.runner.didFailBot(self, data.get("reason"))
+        elif packageType == "notification":
+            parameters = data.get("parameters") or {}
+            if data.get("event_type") == "user_list" and parameters.get("channel") == self.channel and not self.ready:
+                self.ready = True
+                self.runner.didReadyBot(self)
+
+    def sendPackage(self, package):
+        self.transport.write(self.frameBuffer.encode(self.codec.encode(package)))
+
+    def sendMessage(self):
+        self.sendPackage({"type": "message", "data": {"message": "bench:%.6f:%s" % (time.time(), self.username)}})
+        self.runner.sent += 1
+
+    def join(self, channel):
+        self.channel = channel
+        self.sendPackage({"type": "command", "data": {"command": "join", "parameters": {"channel": channel}}})
+
+class BotFactory(ClientFactory):
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def buildProtocol(self, addr):
+        return self.bot
+
+    def clientConnectionFailed(self, connector, reason):
+        self.bot.runner.didFailBot(self.bot, reason.getErrorMessage())
+
+class BenchmarkRunner(object):
+    """
+        Runs a scenario and collects the numbers.
+
+        Args:
+            options (obj)   :   The parsed command line options.
+            offset (int)    :   The number of the first bot of this process.
+    """
+
+    def __init__(self, options, offset=0):
+        self.options = options
+        self.offset = offset
+        self.bots = []
+        self.readyCount = 0
+        self.failed = 0
+        self.sent = 0
+        self.received = 0
+        self.bytesReceived = 0
+        self.latencies = LatencySamples()
+        self.measuring = False
+        self.credit = 0.0
+
+    def channelFor(self, number):
+        if self.options.scenario == "huge-room":
+            return "bench"
+        return "bench-%d" % (number // self.options.room_size)
+
+    def start(self):
+        """
+            Connects the bots, a batch per reactor turn so the server
+            is not flooded with connection attempts.
+        """
+        numbers = list(range(self.offset, self.offset + self.options.bots))
+
+        def connectBatch():
+            for number in numbers[:100]:
+                bot = Bot(self, "bot%d" % number, self.channelFor(number))
+                self.bots.append(bot)
+                reactor.connectTCP(self.options.host, self.options.port, BotFactory(bot))
+            del numbers[:100]
+            if numbers:
+                reactor.callLater(0.01, connectBatch)
+        connectBatch()
+        reactor.callLater(self.options.timeout, self.__didTimeOut)
+
+    def didReadyBot(self, bot):
+        self.readyCount += 1
+        self.__checkReady()
+
+    def didFailBot(self, bot, reason):
+        self.failed += 1
+        sys.stderr.write("bot %s failed: %s\n" % (bot.username, reason))
+        self.__checkReady()
+
+    def didLoseBot(self, bot):
+        pass
+
+    def didReceiveMessage(self, sentAt):
+        if self.measuring:
+            self.received += 1
+            self.latencies.add(time.time() - sentAt)
+
+    def report(self, elapsed, cpuStart):
+        """
+            Returns:
+                A dictionary with the numbers of this process.
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "bots": self.readyCount,
+            "failed": self.failed,
+            "sent": self.sent,
+            "received": self.received,
+            "bytes": self.bytesReceived,
+            "seconds": elapsed,
+            "cpu": usage.ru_utime + usage.ru_stime - cpuStart,
+            "rss": usage.ru_maxrss,
+            "latencies": self.latencies.samples
+        }
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __checkReady(self):
+        if self.readyCount + self.failed == self.options.bots and not self.measuring:
+            self.__measure()
+
+    def __measure(self):
+        """
+            Starts the senders, and the churn, for the duration of the run.
+        """
+        self.measuring = True
+        senders = [bot for bot in self.bots if bot.ready][:self.options.senders]
+        others = [bot for bot in self.bots if bot.ready][self.options.senders:]
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpuStart = usage.ru_utime + usage.ru_stime
+        startedAt = time.time()
+        tick = 0.01
+
+        def send():
+            self.credit += self.options.rate * tick
+            while self.credit >= 1 and senders:
+                random.choice(senders).sendMessage()
+                self.credit -= 1
+        loops = [task.LoopingCall(send)]
+
+        if self.options.scenario == "churn" and others:
+            rooms = max(1, self.options.bots // self.options.room_size)
+
+            def churn():
+                for _ in range(max(1, int(self.options.churn * tick))):
+                    bot = random.choice(others)
+                    bot.join("bench-%d" % random.randint(0, rooms - 1))
+            loops.append(task.LoopingCall(churn))
+
+        for loop in loops:
+            loop.start(tick, now=False)
+
+        def finish():
+            for loop in loops:
+                loop.stop()
+            # Give the last messages time to arrive.
+            reactor.callLater(1.0, self.__finish, time.time() - startedAt, cpuStart)
+        reactor.callLater(self.options.duration, finish)
+
+    def __finish(self, elapsed, cpuStart):
+        self.result = self.report(elapsed, cpuStart)
+        reactor.stop()
+
+    def __didTimeOut(self):
+        if not self.measuring:
+            sys.stderr.write("Only %d of %d bots logged in, giving up.\n" % (self.readyCount, self.options.bots))
+            self.result = None
+            reactor.stop()
+
+def processStatus(pid):
+    """
+        Returns the CPU seconds and resident memory, in kilobytes, of
+        another process, as found in /proc.
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf(os.sysconf_names["SC_CLK_TCK"])
+        cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+        with open("/proc/%d/status" % pid) as f:
+            rss = [int(line.split()[1]) for line in f if line.startswith("VmRSS:")][0]
+        return cpu, rss
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+
+def printReport(options, results, server):
+    """
+        Merges the numbers of every process and prints them.
+    """
+    samples = LatencySamples()
+    for result in results:
+        for latency in result["latencies"]:
+            samples.add(latency)
+    seconds = max(result["seconds"] for result in results)
+    sent = sum(result["sent"] for result in results)
+    received = sum(result["received"] for result in results)
+    report = {
+        "scenario": options.scenario,
+        "codec": options.codec,
+        "bots": sum(result["bots"] for result in results),
+        "failed": sum(result["failed"] for result in results),
+        "sent_per_second": sent / seconds,
+        "delivered_per_second": received / seconds,
+        "received_bytes_per_second": sum(result["bytes"] for result in results) / seconds,
+        "latency_p50_ms": samples.percentile(0.50) * 1000,
+        "latency_p99_ms": samples.percentile(0.99) * 1000,
+        "client_cpu_seconds": sum(result["cpu"] for result in results),
+        "client_rss_kb": sum(result["rss"] for result in results)
+    }
+    report.update(server)
+
+    if options.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        for key in sorted(report):
+            value = report[key]
+            print("%-26s %s" % (key, "%.2f" % value if isinstance(value, float) else value))
+
+def runProcesses(options):
+    """
+        Spreads the bots over several benchmark processes, and merges
+        their reports.
+    """
+    share = options.bots // options.processes
+    children = []
+    for index in range(options.processes):
+        arguments = [sys.executable, os.path.abspath(__file__), options.scenario,
+            "--host", options.host, "--port", str(options.port),
+            "--bots", str(share), "--offset", str(index * share),
+            "--senders", str(max(1, options.senders // options.processes)),
+            "--rate", str(options.rate / float(options.processes)),
+            "--churn", str(options.churn / float(options.processes)),
+            "--room-size", str(options.room_size), "--codec", options.codec,
+            "--duration", str(options.duration), "--timeout", str(options.timeout),
+            "--child"]
+        children.append(subprocess.Popen(arguments, stdout=subprocess.PIPE))
+    results = []
+    for child in children:
+        output = child.communicate()[0]
+        if child.returncode == 0 and output:
+            results.append(json.loads(output))
+    return results
+
+def runInProcess(options):
+    """
+        Runs the bots in this process, and returns their numbers.
+    """
+    runner = BenchmarkRunner(options, options.offset)
+    runner.result = None
+    reactor.callWhenRunning(runner.start)
+    reactor.run()
+    return runner.result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ChatMaster 3000 server.")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="the port of a running server, otherwise one is started in-process")
+    parser.add_argument("--server-pid", type=int, help="the pid of the server, to report its CPU and memory")
+    parser.add_argument("--bots", type=int, default=1000, help="the number of simulated clients")
+    parser.add_argument("--senders", type=int, default=10, help="the number of bots sending messages")
+    parser.add_argument("--rate", type=float, default=200.0, help="the messages sent per second, in total")
+    parser.add_argument("--room-size", type=int, default=20, help="the users per room, in small-rooms and churn")
+    parser.add_argument("--churn", type=float, default=50.0, help="the joins per second, in churn")
+    parser.add_argument("--duration", type=float, default=10.0, help="the seconds to measure")
+    parser.add_argument("--timeout", type=float, default=60.0, help="the seconds to wait for the bots to log in")
+    parser.add_argument("--codec", choices=CODEC_NAMES, default="json", help="the codec the bots ask for")
+    parser.add_argument("--flush-interval", type=float, help="the write batching of the in-process server, see run.py")
+    parser.add_argument("--processes", type=int, default=1, help="the number of benchmark processes")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--offset", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    server = {}
+    serverPid = options.server_pid
+    serverStart = (None, None)
+    if options.port is None:
+        if options.processes > 1:
+            parser.error("--processes requires the --port of a running server")
+        from core.cmserverfactory import CMServerFactory
+        # The bots send far more than a user is allowed to.
+        factory = CMServerFactory()
+        factory.messageRate = factory.channelMessageRate = None
+        factory.flushInterval = options.flush_interval
+        options.port = reactor.listenTCP(0, factory, backlog=1024, interface=options.host).getHost().port
+        server["server"] = "in-process"
+    elif serverPid is not None:
+        serverStart = processStatus(serverPid)
+
+    if options.child:
+        result = runInProcess(options)
+        if result is None:
+            sys.exit(1)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    if options.processes > 1:
+        results = runProcesses(options)
+    else:
+        result = runInProcess(options)
+        results = [result] if result is not None else []
+    if not results:
+        sys.exit("The benchmark did not complete.")
+
+    if server.get("server") == "in-process":
+        server["server_writes"] = factory.metrics.writes
+    if serverPid is not None:
+        cpu, rss = processStatus(serverPid)
+        if cpu is not None and serverStart[0] is not None:
+            server["server_cpu_seconds"] = cpu - serverStart[0]
+            server["server_rss_kb"] = rss
+    printReport(options, results, server)
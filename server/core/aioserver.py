@@ -0,0 +1,204 @@
+"""
+    Runs the server on an asyncio event loop instead of the Twisted
+    reactor.
+
+    The protocol and factory are the very same as on Twisted. Every
+    asyncio connection is bridged to a CMServer instance through a small
+    transport adapter, and timed work is scheduled through a clock
+    adapter, so that the routing and bookkeeping never know which event
+    loop they run on.
+
+    Note:
+        Requires Python 3. The message log and the worker bus are built
+        on the reactor, and are not available here.
+"""
+import asyncio
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+from core.cmserverfactory import CMServerFactory
+
+# The event loops to choose from.
+LOOP_ASYNCIO    = "asyncio"
+LOOP_UVLOOP     = "uvloop"
+
+class DelayedCall(object):
+    """
+        A call scheduled on an asyncio loop, looking like the ones
+        returned by the reactor's callLater().
+    """
+
+    def __init__(self, loop, delay, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+        self.handle = loop.call_later(delay, self.__fire)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+        self.handle.cancel()
+
+    def getTime(self):
+        return self.handle.when()
+
+    def __fire(self):
+        self.called = True
+        self.function(*self.args, **self.kwargs)
+
+class AsyncioClock(object):
+    """
+        Schedules timed work on an asyncio loop, with the callLater()
+        and seconds() methods of the reactor.
+
+        Args:
+            loop (obj)  :   The event loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, function, *args, **kwargs):
+        return DelayedCall(self.loop, delay, function, args, kwargs)
+
+class AsyncioTransport(object):
+    """
+        Adapts an asyncio transport to the part of the Twisted transport
+        interface used by the server protocol.
+
+        Args:
+            transport (obj) :   The asyncio transport.
+            producer (obj)  :   The producer paused and resumed along
+                                with the transport's write buffer.
+    """
+
+    producer = None
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writelines(data)
+
+    def loseConnection(self):
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def getPeer(self):
+        return self.transport.get_extra_info("peername")
+
+class AsyncioProtocol(asyncio.Protocol):
+    """
+        Bridges an asyncio connection to a server protocol built by
+        the factory.
+
+        Args:
+            factory (obj)   :   The server factory.
+            protocol (obj)  :   The server protocol of the connection.
+    """
+
+    protocol = None
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connection_made(self, transport):
+        self.transport = AsyncioTransport(transport)
+        self.protocol = self.factory.buildProtocol(self.transport.getPeer())
+        self.protocol.makeConnection(self.transport)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        producer = self.transport.producer
+        if producer is not None:
+            producer.stopProducing()
+        if exc is None:
+            reason = Failure(ConnectionDone())
+        else:
+            reason = Failure(ConnectionLost(str(exc)))
+        self.protocol.connectionLost(reason)
+
+    def pause_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.pauseProducing()
+
+    def resume_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+
+class MetricsProtocol(asyncio.Protocol):
+    """
+        Answers every HTTP request with the metrics of the server, as
+        the Twisted MetricsResource does.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.request = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b"\r\n\r\n" not in self.request:
+            return
+        body = self.factory.metrics.render(self.factory).encode("utf-8")
+        headers = "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: %d\r\n\r\n" % len(body)
+        self.transport.write(headers.encode("ascii") + body)
+        self.transport.close()
+
+def newEventLoop(name=LOOP_ASYNCIO):
+    """
+        Creates the event loop to run on.
+
+        Args:
+            name (str)  :   The event loop, "asyncio" or "uvloop".
+    """
+    if name == LOOP_UVLOOP:
+        import uvloop
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+def runAsyncio(port, loopName=LOOP_ASYNCIO, backlog=100, metricsPort=None):
+    """
+        Runs the server on an asyncio event loop, until interrupted.
+
+        Args:
+            port (int)          :   The port to listen on.
+            loopName (str)      :   The event loop, "asyncio" or "uvloop".
+            backlog (int)       :   The length of the accept queue.
+            metricsPort (int)   :   The local port to serve metrics on.
+    """
+    loop = newEventLoop(loopName)
+    asyncio.set_event_loop(loop)
+    factory = CMServerFactory(clock=AsyncioClock(loop))
+    server = loop.run_until_complete(loop.create_server(lambda: AsyncioProtocol(factory), port=port, backlog=backlog))
+    if metricsPort is not None:
+        loop.run_until_complete(loop.create_server(lambda: MetricsProtocol(factory), host="127.0.0.1", port=metricsPort))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.close()
@@ -0,0 +1,277 @@
+from twisted.internet import defer
+from twisted.internet.protocol import Factory, Protocol
+from shared.framing import FrameBuffer, FramingError
+import json
+
+class BusProtocol(Protocol):
+    """
+        The base protocol of the room bus.
+
+        Events are small JSON objects with an "op" attribute, sent
+        newline framed over a local Unix socket.
+    """
+
+    frameBuffer = None
+
+    def connectionMade(self):
+        self.frameBuffer = FrameBuffer()
+
+    def dataReceived(self, data):
+        """
+            Splits the received data into events, and hands them to
+            eventReceived().
+
+            Args:
+                data (str) : The data received.
+        """
+        self.frameBuffer.feed(data)
+        try:
+            for frame in self.frameBuffer.frames():
+                self.eventReceived(json.loads(frame))
+        except (FramingError, ValueError):
+            self.transport.loseConnection()
+
+    def eventReceived(self, event):
+        """
+            Invoked for every event received.
+
+            Args:
+                event (dict)    :   The event.
+        """
+        pass
+
+    def sendEvent(self, event):
+        """
+            Sends an event.
+
+            Args:
+                event (dict)    :   The event.
+        """
+        self.transport.write(self.frameBuffer.encode(json.dumps(event).encode("utf-8")))
+
+class BusHubProtocol(BusProtocol):
+    """
+        The hub side of a connection to a worker process.
+
+        Args:
+            worker (int)    :   The id of the worker, known after its hello.
+    """
+
+    worker = None
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def connectionLost(self, reason):
+        self.hub.didLoseWorker(self)
+
+    def eventReceived(self, event):
+        """
+            Handles an event sent by the worker.
+        """
+        op = event.get("op")
+        if op == "hello":
+            self.worker = event["worker"]
+            self.hub.didAddWorker(self)
+        elif op == "claim":
+            granted = self.hub.claimUsername(event["username"], self.worker)
+            self.sendEvent({"op": "claimed", "id": event["id"], "granted": granted})
+        elif op == "release":
+            self.hub.releaseUsername(event["username"], self.worker)
+        else:
+            self.hub.relay(event, self)
+
+class BusHub(Factory):
+    """
+        The room bus hub, run by the master process.
+
+        The hub relays room events between the worker processes, and
+        is the authority on which usernames are taken. It also keeps
+        the members of every channel, so that workers connecting late,
+        or surviving a lost worker, can be brought up to date.
+
+        Args:
+            workers (set)   :   The connected workers.
+            claims (dict)   :   The worker owning each claimed username.
+            members (dict)  :   The worker of every user inside each
+                                channel, keyed by channel name.
+            private (set)   :   The channels made private.
+    """
+
+    def __init__(self):
+        self.workers = set()
+        self.claims = {}
+        self.members = {}
+        self.private = set()
+
+    def buildProtocol(self, addr):
+        return BusHubProtocol(self)
+
+    def didAddWorker(self, worker):
+        """
+            Adds a worker, and sends it the current channel members.
+        """
+        self.workers.add(worker)
+        for channel, users in self.members.items():
+            for username, owner in users.items():
+                worker.sendEvent({"op": "join", "channel": channel, "username": username, "worker": owner})
+        for channel in self.private:
+            worker.sendEvent({"op": "visibility", "channel": channel, "public": False})
+
+    def didLoseWorker(self, worker):
+        """
+            Drops the usernames and channel members of a lost worker,
+            and tells the others about it.
+        """
+        self.workers.discard(worker)
+        for username, owner in list(self.claims.items()):
+            if owner == worker.worker:
+                del self.claims[username]
+        for channel, users in list(self.members.items()):
+            for username, owner in list(users.items()):
+                if owner == worker.worker:
+                    del users[username]
+            if not users:
+                del self.members[channel]
+                self.private.discard(channel)
+        self.relay({"op": "worker_lost", "worker": worker.worker}, worker)
+
+    def claimUsername(self, username, worker):
+        """
+            Claims a username for a worker.
+
+            Returns:
+                True if the username was free, otherwise False.
+        """
+        owner = self.claims.get(username)
+        if owner is not None and owner != worker:
+            return False
+        self.claims[username] = worker
+        return True
+
+    def releaseUsername(self, username, worker):
+        """
+            Releases a username claimed by a worker.
+        """
+        if self.claims.get(username) == worker:
+            del self.claims[username]
+
+    def relay(self, event, sender):
+        """
+            Records membership changes and relays an event to every
+            worker except the sender.
+        """
+        op = event.get("op")
+        if op == "join":
+            self.members.setdefault(event["channel"], {})[event["username"]] = event["worker"]
+        elif op == "leave":
+            users = self.members.get(event["channel"], {})
+            users.pop(event["username"], None)
+            if not users:
+                self.members.pop(event["channel"], None)
+                self.private.discard(event["channel"])
+        elif op == "rename":
+            users = self.members.get(event["channel"], {})
+            if users.pop(event["old_username"], None) is not None:
+                users[event["new_username"]] = event["worker"]
+        elif op == "visibility":
+            if event["public"]:
+                self.private.discard(event["channel"])
+            else:
+                self.private.add(event["channel"])
+
+        data = sender.frameBuffer.encode(json.dumps(event).encode("utf-8"))
+        for worker in self.workers:
+            if worker is not sender:
+                worker.transport.write(data)
+
+class BusClient(BusProtocol):
+    """
+        The worker side of the room bus.
+
+        Relays the room events of the local server factory to the other
+        workers, and applies theirs to it.
+
+        Args:
+            factory (obj)           :   The local server factory.
+            worker (int)            :   The id of this worker.
+            onConnectionLost (func) :   Called when the hub goes away.
+    """
+
+    onConnectionLost = None
+
+    def __init__(self, factory, worker):
+        self.factory = factory
+        self.worker = worker
+        self.claims = {}
+        self.nextClaim = 0
+
+    def connectionMade(self):
+        BusProtocol.connectionMade(self)
+        self.sendEvent({"op": "hello", "worker": self.worker})
+        self.factory.bus = self
+
+    def connectionLost(self, reason):
+        self.factory.didLoseBus()
+        for deferred in self.claims.values():
+            deferred.callback(False)
+        self.claims = {}
+        if self.onConnectionLost is not None:
+            self.onConnectionLost()
+
+    def eventReceived(self, event):
+        """
+            Applies an event relayed from another worker.
+        """
+        op = event.get("op")
+        if op == "publish":
+            payload = event["payload"].encode("utf-8")
+            self.factory.didReceiveRemotePayload(payload, event["channel"], event.get("record"), event.get("kind"))
+        elif op == "join":
+            self.factory.didJoinRemoteChannel(event["channel"], event["username"], event["worker"])
+        elif op == "leave":
+            self.factory.didLeaveRemoteChannel(event["channel"], event["username"])
+        elif op == "rename":
+            self.factory.didRenameRemoteUser(event["channel"], event["old_username"], event["new_username"], event["worker"])
+        elif op == "visibility":
+            self.factory.didChangeVisibility(event["channel"], event["public"])
+        elif op == "worker_lost":
+            self.factory.didLoseRemoteWorker(event["worker"])
+        elif op == "claimed":
+            deferred = self.claims.pop(event["id"], None)
+            if deferred is not None:
+                deferred.callback(event["granted"])
+
+    def publish(self, channel, payload, record=False, kind=None):
+        """
+            Relays an encoded package to the members of a channel on
+            the other workers, optionally to be kept in its history.
+        """
+        self.sendEvent({"op": "publish", "channel": channel, "payload": payload.decode("utf-8"), "record": record, "kind": kind})
+
+    def join(self, channel, username):
+        self.sendEvent({"op": "join", "channel": channel, "username": username, "worker": self.worker})
+
+    def leave(self, channel, username):
+        self.sendEvent({"op": "leave", "channel": channel, "username": username})
+
+    def rename(self, channel, oldUsername, newUsername):
+        self.sendEvent({"op": "rename", "channel": channel, "old_username": oldUsername, "new_username": newUsername, "worker": self.worker})
+
+    def setVisibility(self, channel, public):
+        self.sendEvent({"op": "visibility", "channel": channel, "public": public})
+
+    def claim(self, username):
+        """
+            Asks the hub for a username.
+
+            Returns:
+                A Deferred firing with True if the username was granted.
+        """
+        self.nextClaim += 1
+        deferred = self.claims[self.nextClaim] = defer.Deferred()
+        self.sendEvent({"op": "claim", "username": username, "id": self.nextClaim})
+        return deferred
+
+    def release(self, username):
+        self.sendEvent({"op": "release", "username": username})
@@ -0,0 +1,58 @@
+class Channel(object):
+    """
+        A channel, and everything the server keeps about it.
+
+        Note:
+            Channels are kept by name in the factory's channels
+            dictionary. The attributes are slotted, as a server may hold
+            many thousands of small channels.
+
+        Args:
+            name (str)          :   The name of the channel.
+            public (bool)       :   Whether the channel is listed in the
+                                    channel list.
+            persistent (bool)   :   Whether the channel is kept once
+                                    empty, as the default channels are.
+            created (float)     :   When the channel was created.
+            members (set)       :   The local connections inside the channel.
+            remoteMembers (dict):   The worker of every user inside the
+                                    channel on other workers, keyed by
+                                    username.
+            history (obj)       :   The recent messages, once any was sent.
+            bucket (obj)        :   The rate limit of the messages routed
+                                    to the channel, once any was sent.
+            messages (int)      :   The messages sent to the channel.
+    """
+
+    __slots__ = ("name", "public", "persistent", "created", "members", "remoteMembers", "history", "bucket", "messages")
+
+    def __init__(self, name, created, public=True, persistent=False):
+        self.name = name
+        self.public = public
+        self.persistent = persistent
+        self.created = created
+        self.members = set()
+        self.remoteMembers = {}
+        self.history = None
+        self.bucket = None
+        self.messages = 0
+
+    def __len__(self):
+        return len(self.members) + len(self.remoteMembers)
+
+    def isEmpty(self):
+        """
+            Returns:
+                True if nobody, on any worker, is inside the channel.
+        """
+        return not self.members and not self.remoteMembers
+
+    def usernames(self):
+        """
+            Returns:
+                The usernames of the users inside the channel, on this
+                server and on other workers.
+        """
+        users = [connection.session.username for connection in self.members]
+        users.extend(self.remoteMembers)
+        return users
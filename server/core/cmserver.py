@@ -1,20 +1,44 @@
 from twisted.internet.protocol import Protocol
+from shared.framing import FrameBuffer, FramingError, FRAMING_MODES, FRAMING_LENGTH, negotiateFraming
+from shared.compression import StreamCompressor, CompressionError, negotiateCompression
+from support.packages import newPackage, newMessage, newNotification, packageKind
+from shared.codec import CODEC_JSON, getCodec, decodePackage, negotiateCodec
+from core.dispatcher import Dispatcher, DispatchError, stringTypes
+from core.outputqueue import OutputQueue
+from core.session import Session
+from timeit import default_timer
 import json
 
+dispatcher = Dispatcher()
+
 class CMServer(Protocol):
     """
         The server protocol handles each new incoming connection.
 
         Args:
-            username (str)  :   The username.
-            channel  (str)  :   The channel the client is currently in.
+            session (obj)    :  The state of the connection, see Session.
+            frameBuffer (obj):  The buffer splitting the stream into packages.
+            outputQueue (obj):  The packages waiting while the transport
+                                is paused, created when first needed.
+            paused (bool)    :  Whether the transport has asked for a pause.
+            pendingFrames (list):   The frames waiting for the next flush,
+                                    when writes are batched.
+            pendingBytes (int)  :   The size of the pending frames.
+            dispatcher (obj) :  The dispatcher routing packages to the
+                                handler methods below.
     """
 
-    username = None
-    channel = None
+    session = None
+    frameBuffer = None
+    outputQueue = None
+    paused = False
+    pendingFrames = None
+    pendingBytes = 0
+    dispatcher = dispatcher
 
     def __init__(self):
-        pass
+        self.session = Session(getCodec(CODEC_JSON))
+        self.frameBuffer = FrameBuffer()
 
     def connectionMade(self):
         """
@@ -22,7 +46,14 @@ class CMServer(Protocol):
 
             All new connections must be added to the factory, through
             the factory method addConnection().
+
+            The protocol registers itself as a producer with the
+            transport, which pauses it once its write buffer fills up.
         """
+        session = self.session
+        session.lastActivity = self.factory.clock.seconds()
+        session.messageBucket = self.factory.newMessageBucket()
+        self.transport.registerProducer(self, True)
         self.factory.addConnection(self)
         self.sendRequest("login")
 
@@ -33,80 +64,388 @@ class CMServer(Protocol):
             Must call the factory method removeConnection().
         """
         self.factory.removeConnection(self)
-        if self.channel is not None:
-            self.factory.didLeaveChannel(self.channel, self.username)
+        channel = self.session.channel
+        if channel is not None:
+            self.factory.didLeaveChannel(channel, self)
 
     def dataReceived(self, data):
         """
             Received data.
 
-            This method checks and parses the data received. The
-            data can be either a message or a command package.
+            The data is fed to the frame buffer, and every complete
+            frame is decompressed, if compression has been negotiated,
+            decoded and handed to packageReceived(). A stream that can
+            not be framed or decompressed drops the connection.
+
+            Args:
+                data (str) : The data received.
+        """
+        factory = self.factory
+        factory.metrics.bytesReceived += len(data)
+        # Any data proves the peer is alive, the heartbeat wheel picks
+        # this up the next time it checks the connection.
+        session = self.session
+        session.lastActivity = factory.clock.seconds()
+        session.awaitingPong = False
+        self.frameBuffer.feed(data)
+        try:
+            for frame in self.frameBuffer.frames():
+                if session.compressor is not None:
+                    frame = session.compressor.decompress(frame)
+                try:
+                    package = decodePackage(frame)
+                except ValueError:
+                    continue
+                self.packageReceived(package)
+        except (FramingError, CompressionError):
+            self.transport.loseConnection()
+
+    def packageReceived(self, data):
+        """
+            Received a package.
+
+            The package is handed to the dispatcher, which looks up the
+            handler registered for its type and command. Errors raised
+            while dispatching are sent back to the client.
+
+            See PROTOCOL.md for available commands.
+
+            Args:
+                data (dict) : The package received.
+        """
+        try:
+            self.dispatcher.dispatch(self, data)
+        except DispatchError as error:
+            self.sendError(error.errorType, error.message)
+
+    ##########################
+    #   Package handlers
+    ##########################
+
+    @dispatcher.command("login", [("username", stringTypes)])
+    def handleLogin(self, parameters):
+        """
+            Logs the user in, if the username is not already taken.
+        """
+        if self.session.username is not None:
+            self.sendError("login", "You are already logged in.")
+            return
+        # The framing mode is switched before the session package
+        # is sent, as the client switches right after the login.
+        framing = negotiateFraming(parameters.get("framing"))
+        self.frameBuffer.setMode(framing)
+        # Compressed and binary frames may contain newlines, and are
+        # only offered on length prefixed connections.
+        compression = None
+        codec = CODEC_JSON
+        if framing == FRAMING_LENGTH:
+            compression = negotiateCompression(parameters.get("compression"))
+            codec = negotiateCodec(parameters.get("codecs"))
+        username = parameters["username"]
+        token = parameters.get("resume")
+        if not isinstance(token, stringTypes):
+            token = None
+        if token is not None:
+            self.factory.takeOverSession(username, token)
+        deferred = self.factory.claimUsername(username, self)
+        deferred.addCallback(self.__didClaimUsername, username, compression, codec, token, parameters.get("seen"))
+
+    @dispatcher.command("rename", [("username", stringTypes)])
+    def handleRename(self, parameters):
+        """
+            Changes the username, if the new one is not already taken.
+        """
+        username = parameters["username"]
+        if self.session.username is None:
+            self.sendError("rename", "You are not logged in.")
+        elif username == self.session.username:
+            self.sendError("rename", "You are already using that username.")
+        else:
+            self.factory.renameUser(self, username).addCallback(self.__didRename)
+
+    @dispatcher.command("channels")
+    @dispatcher.command("channel_list")
+    def handleChannelList(self, parameters):
+        """
+            Sends the current channels list.
+        """
+        self.sendChannelList()
+
+    @dispatcher.command("users")
+    def handleUsers(self, parameters):
+        """
+            Sends the full list of users inside the current channel.
+        """
+        if self.session.channel is None:
+            self.sendError("users", "You are not in a channel.")
+        else:
+            self.factory.sendUserList(self)
+
+    @dispatcher.command("join", [("channel", stringTypes)])
+    def handleJoin(self, parameters):
+        """
+            Joins or creates a channel.
+        """
+        channel = parameters["channel"]
+        session = self.session
+        if session.channel != channel:
+            if session.channel is not None:
+                # Leave the current channel first, so that it stays
+                # in sync with the factory's members index.
+                previous = session.channel
+                session.channel = None
+                self.factory.didLeaveChannel(previous, self)
+            self.factory.didJoinChannel(channel, self)
+            session.channel = channel
+        else:
+            self.sendError("join", "You have already joined the channel.")
+
+    @dispatcher.command("leave")
+    def handleLeave(self, parameters):
+        """
+            Leaves the current channel.
+        """
+        channel = self.session.channel
+        if channel is not None:
+            # The channel must be set to None before calling didLeave Channel
+            # as that method is sending out a notification to all users in the
+            # channel.
+            self.session.channel = None
+            self.factory.didLeaveChannel(channel, self)
+            self.sendChannelList()
+        else:
+            self.sendError("leave", "You are not in a channel.")
+
+    @dispatcher.command("private")
+    def handlePrivate(self, parameters):
+        """
+            Hides the current channel from the channel list.
+        """
+        self.__changeVisibility("private", False)
+
+    @dispatcher.command("public")
+    def handlePublic(self, parameters):
+        """
+            Lists the current channel in the channel list.
+        """
+        self.__changeVisibility("public", True)
+
+    @dispatcher.command("history")
+    def handleHistory(self, parameters):
+        """
+            Sends earlier messages of the current channel, either the
+            last "count" ones or those sent "since" a timestamp.
+        """
+        count = parameters.get("count")
+        since = parameters.get("since")
+        if self.session.channel is None:
+            self.sendError("history", "You are not in a channel.")
+        elif count is not None and not isinstance(count, int):
+            self.sendError("history", "The count must be a number.")
+        elif since is not None and not isinstance(since, (int, float)):
+            self.sendError("history", "The timestamp must be a number.")
+        else:
+            self.factory.queryHistory(self.session.channel, count, since).addCallback(self.sendPayloads)
+
+    @dispatcher.handler("ping")
+    def handlePing(self, parameters):
+        """
+            Answers a ping, echoing its data.
+        """
+        self.sendPackage(newPackage("pong", parameters))
+
+    @dispatcher.handler("pong")
+    def handlePong(self, parameters):
+        """
+            Nothing to do, receiving the pong was the point.
+        """
+        pass
+
+    @dispatcher.handler("message", parameters=[("message", stringTypes)])
+    def handleMessage(self, parameters):
+        """
+            Routes a message to the users in the current channel,
+            unless the connection or the channel is over its rate.
+        """
+        refusal = self.factory.allowMessage(self)
+        if refusal is not None:
+            self.factory.metrics.messagesLimited += 1
+            self.sendError("message", refusal)
+            return
+        self.factory.sendMessage(parameters["message"], self, self.session.channel)
+
+    ##########################
+    #   Send methods
+    ##########################
+
+    def sendPackage(self, package):
+        """
+            Encodes, frames and sends a package.
+
+            Args:
+                package (dict)  :   The package to send.
+        """
+        start = default_timer()
+        payload = self.session.codec.encode(package)
+        self.factory.metrics.encodeLatency.observe(default_timer() - start)
+        self.sendPayload(payload, packageKind(package))
+
+    def sendPayload(self, payload, kind=None):
+        """
+            Frames and sends an already encoded package.
+
+            Note:
+                While the client is behind, the package is queued, and
+                a client too far behind is disconnected.
+
+            Args:
+                payload (str)   :   The encoded package.
+                kind (str)      :   The kind of package, see packageKind().
+        """
+        self.factory.metrics.didSendPackages(kind)
+        if self.isBlocked():
+            if self.outputQueue is None:
+                factory = self.factory
+                self.outputQueue = OutputQueue(factory.outputHighWatermark, factory.outputLowWatermark, factory.outputPolicies, factory.metrics)
+            if not self.outputQueue.push(kind, payload):
+                self.dropConnection()
+            return
+        self.__writePayload(payload)
+
+    def sendPayloads(self, payloads):
+        """
+            Frames a list of encoded messages and sends them in a
+            single write.
+
+            Note:
+                The messages are JSON encoded, as kept in the history,
+                and are re-encoded if the connection uses another codec.
+
+            Args:
+                payloads (list) :   The encoded message packages.
+        """
+        codec = self.session.codec
+        if codec.name != CODEC_JSON:
+            payloads = [codec.encode(json.loads(payload)) for payload in payloads]
+        if self.isBlocked():
+            for payload in payloads:
+                self.sendPayload(payload, "message")
+            return
+        self.factory.metrics.didSendPackages("message", len(payloads))
+        compressor = self.session.compressor
+        frames = []
+        for payload in payloads:
+            if compressor is not None:
+                payload = compressor.compress(payload)
+            frames.append(self.frameBuffer.encode(payload))
+        if frames:
+            self.sendFrame(b"".join(frames))
+
+    def sendFrame(self, frame):
+        """
+            Sends an already encoded and framed package.
 
-            Messages should be rerouted to the right channel, with the
-            server factory method sendMessage(message, toChannel).
+            Note:
+                The factory's broadcast() frames a package once per
+                framing mode, and hands the same frame to every
+                recipient that is not blocked through here.
 
-            Commands should be handled appropriately. See PROTOCOL.md
-            for available commands.
+                When the factory batches writes, the frame is kept until
+                the next flush, or until flushBytes are pending, so that
+                a busy room costs one write per connection and tick
+                rather than one per message.
 
             Args:
-                data (json) : The data received.
-        """
-        data = json.loads(data)
-        if data["type"] == "command":
-            command = data["data"]["command"]
-            if command == "login":
-                username = data["data"]["parameters"]["username"]
-                nameUnique = self.factory.isUsernameUnique(username)
-                if nameUnique:
-                    self.sendSession(nameUnique)
-                    self.username = username
-                else:
-                    self.sendSession(nameUnique, "Username is already taken")
-            # TODO: Add more commands
-            elif command == "channel_list":
-                self.sendChannelList()
-            elif command == "join":
-                channel = data["data"]["parameters"]["channel"]
-                if self.channel != channel:
-                    self.channel = data["data"]["parameters"]["channel"]
-                    self.factory.didJoinChannel(self.channel, self.username)
-                else:
-                    self.sendError(command, "You have already joined the channel.")
-            elif command == "leave":
-                if self.channel is not None:
-                    channel = self.channel
-                    # The channel must be set to None before calling didLeave Channel
-                    # as that method is sending out a notification to all users in the
-                    # channel.
-                    self.channel = None
-                    self.factory.didLeaveChannel(channel, self.username)
-                    self.sendChannelList()
-                else:
-                    self.sendError(command, "You are not in a channel.")
-        elif data["type"] == "message":
-            message = data["data"]["message"]
-            self.factory.sendMessage(message, self.username, self.channel)
-
-        # TODO: Add more package types
+                frame (str) :   The framed package.
+        """
+        factory = self.factory
+        factory.metrics.bytesSent += len(frame)
+        if factory.flushInterval is None:
+            factory.metrics.writes += 1
+            self.transport.write(frame)
+            return
+        frames = self.pendingFrames
+        if frames is None:
+            frames = self.pendingFrames = []
+            factory.scheduleFlush(self)
+        frames.append(frame)
+        self.pendingBytes += len(frame)
+        if self.pendingBytes >= factory.flushBytes:
+            self.flushFrames()
+
+    def flushFrames(self):
+        """
+            Writes the pending frames, in a single write.
+        """
+        frames = self.pendingFrames
+        if frames is None:
+            return
+        self.pendingFrames = None
+        self.pendingBytes = 0
+        self.factory.metrics.writes += 1
+        self.transport.write(frames[0] if len(frames) == 1 else b"".join(frames))
+
+    def isBlocked(self):
+        """
+            Returns:
+                True if packages must be queued rather than written,
+                because the transport is paused or packages are waiting.
+        """
+        return self.paused or (self.outputQueue is not None and len(self.outputQueue) > 0)
+
+    ##########################
+    #   Producer methods
+    ##########################
+
+    def pauseProducing(self):
+        """
+            Invoked by the transport when its write buffer is full.
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+            Invoked by the transport when its write buffer has drained.
+            Writes the queued packages, until paused again.
+        """
+        self.paused = False
+        if self.outputQueue is None:
+            return
+        while not self.paused:
+            payload = self.outputQueue.pop()
+            if payload is None:
+                break
+            self.__writePayload(payload)
+
+    def stopProducing(self):
+        """
+            Invoked by the transport when the connection goes away.
+        """
+        self.outputQueue = None
 
     def sendRequest(self, request):
         """
             Creates and sends a request message.
 
+            Note:
+                The login request also offers the framing modes
+                supported by the server.
+
             Args:
                 request (str) : The request to send.
         """
-        data = json.dumps({
+        data = {
             "type": "request",
             "data": {
                 "request": request
             }
-        })
+        }
+        if request == "login":
+            data["data"]["framing"] = FRAMING_MODES
 
-        self.transport.write(data)
+        self.sendPackage(data)
 
-    def sendSession(self, status, reason=None):
+    def sendSession(self, status, reason=None, compression=None, codec=None):
         """
             Send a session message.
 
@@ -127,78 +466,179 @@ class CMServer(Protocol):
             with a reason string.
 
             Args:
-                The status
+                status (bool)       :   The status.
+                reason (str)        :   The reason of a failure.
+                compression (str)   :   The compression method accepted, if any.
+                codec (str)         :   The codec accepted, if not JSON.
         """
-        data = None
         if status is True:
-            # Create session package
-            # and retrieve channels list through appropriate factory method.
-            channels = self.factory.channels
-            data = json.dumps({
-                "type": "session",
-                "data": {
-                    "status": status,
-                    "channels": channels
-                }
-            })
-        else:
-            # Create session package
-            # don't forget reason string
-            data = json.dumps({
-                "type": "session",
-                "data": {
-                    "status": status,
-                    "reason": reason
-                }
-            })
-
-        self.transport.write(data)
-
-        # Don't forget to send it!
+            # The session package is shared by every login with the
+            # same settings, and encoded by the factory.
+            payload = self.factory.sessionPayload(self.session.codec, compression, codec)
+            self.sendPayload(payload, "session")
+            return
+        data = {
+            "type": "session",
+            "data": {
+                "status": status,
+                "reason": reason
+            }
+        }
+        self.sendPackage(data)
 
     def sendError(self, errorType, message):
         """
             Send an error message to the client.
         """
-        data = json.dumps({
+        data = {
             "type": "error",
             "data": {
                 "error_type": errorType,
                 "message": message
             }
-        })
-        self.transport.write(data)
+        }
+        self.sendPackage(data)
 
     def sendNotification(self, event_type, parameters=[]):
         """
             Send a notification to the client.
         """
-        data = json.dumps({
-            "type": "notification",
-            "data": {
-                "event_type": event_type,
-                "parameters": parameters
-            }
-        })
-
-        self.transport.write(data)
+        self.sendPackage(newNotification(event_type, parameters))
 
     def sendMessage(self, message, username):
         """
             Send a message to the client.
         """
-        data = json.dumps({
-            "type": "message",
-            "data": {
-                "message": message,
-                "username": username
-            }
-        })
+        self.sendPackage(newMessage(message, username))
+
+    def sendPing(self):
+        """
+            Asks the client to prove it is still there.
+        """
+        self.sendPackage(newPackage("ping", {}))
 
-        self.transport.write(data)
+    def dropConnection(self):
+        """
+            Drops the connection right away, without waiting for the
+            data not yet written, which a client that has fallen behind
+            or gone away would never read.
+        """
+        self.outputQueue = None
+        self.pendingFrames = None
+        self.pendingBytes = 0
+        abortConnection = getattr(self.transport, "abortConnection", None)
+        if abortConnection is not None:
+            abortConnection()
+        else:
+            self.transport.loseConnection()
 
     def sendChannelList(self):
         """
             Send the current channels list.
         """
-        self.sendNotification("channel_list", {"channels": self.factory.channels})
+        self.sendPayload(self.factory.channelListPayload(self.session.codec), "channel_list")
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __didClaimUsername(self, granted, username, compression, codec, token=None, seen=None):
+        """
+            Completes a login, once the username has been claimed.
+
+            Args:
+                granted (bool)      :   Whether the username was claimed.
+                username (str)      :   The username.
+                compression (str)   :   The compression method negotiated.
+                codec (str)         :   The codec negotiated.
+                token (str)         :   The resume token of a lost session.
+                seen (int)          :   The sequence number of the last
+                                        message the client received.
+        """
+        if not granted:
+            self.sendSession(False, "Username is already taken")
+        elif self not in self.factory.connections:
+            # The connection was lost while waiting for the claim.
+            self.factory.releaseUsername(username, self)
+        else:
+            session = self.session
+            session.username = username
+            # Compression and the codec apply after the session package.
+            self.sendSession(True, compression=compression, codec=codec if codec != CODEC_JSON else None)
+            if compression is not None:
+                session.compressor = StreamCompressor()
+            session.codec = getCodec(codec)
+            self.__resumeSession(token, seen)
+
+    def __resumeSession(self, token, seen=None):
+        """
+            Hands the client a new resume token, and puts it back in the
+            channel of the session it resumes, if any, sending the
+            messages it missed in one write.
+
+            Args:
+                token (str)     :   The resume token of a lost session.
+                seen (int)      :   The sequence number of the last
+                                    message the client received.
+        """
+        session = self.session
+        resumed = None
+        if token is not None:
+            resumed = self.factory.resumeSession(session.username, token, seen)
+        session.resumeToken = self.factory.newResumeToken()
+        channel = resumed[0] if resumed is not None else None
+        self.sendNotification("resume", {"token": session.resumeToken, "resumed": resumed is not None, "channel": channel})
+        if channel is None:
+            return
+        missed = min(resumed[1], self.factory.maxHistoryQuery)
+        self.factory.didJoinChannel(channel, self, replay=False)
+        session.channel = channel
+        if missed > 0:
+            self.factory.queryHistory(channel, missed).addCallback(self.__sendMissedMessages)
+
+    def __sendMissedMessages(self, payloads):
+        """
+            Sends the messages a resumed session missed, leaving out
+            those the user sent, which the client has already shown.
+
+            Args:
+                payloads (list) :   The JSON encoded messages, oldest first.
+        """
+        username = self.session.username
+        payloads = [payload for payload in payloads if json.loads(payload)["data"].get("username") != username]
+        self.sendPayloads(payloads)
+
+    def __changeVisibility(self, command, public):
+        """
+            Makes the current channel public or private, unless it is
+            one of the default channels, which are always public.
+
+            Args:
+                command (str)   :   The command, "public" or "private".
+                public (bool)   :   Whether the channel should be listed.
+        """
+        channel = self.factory.channels.get(self.session.channel)
+        if channel is None:
+            self.sendError(command, "You are not in a channel.")
+        elif channel.public == public:
+            self.sendError(command, "The channel is already %s." % command)
+        elif channel.persistent:
+            self.sendError(command, "Channel cannot be set to %s." % command)
+        else:
+            self.factory.setChannelVisibility(channel.name, public, self.session.username)
+
+    def __writePayload(self, payload):
+        """
+            Compresses, if negotiated, frames and writes a package.
+        """
+        compressor = self.session.compressor
+        if compressor is not None:
+            payload = compressor.compress(payload)
+        self.sendFrame(self.frameBuffer.encode(payload))
+
+    def __didRename(self, renamed):
+        """
+            Reports a failed rename back to the client.
+        """
+        if not renamed:
+            self.sendError("rename", "Username is already taken.")
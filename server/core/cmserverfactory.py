@@ -1,6 +1,16 @@
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import Factory
 from core.cmserver import CMServer
-import json
+from core.channel import Channel
+from core.history import ChannelHistory
+from core.presence import PresenceAggregator
+from core.metrics import Metrics
+from core.timerwheel import TimerWheel
+from core.ratelimit import TokenBucket
+from support.packages import newPackage, newMessage, newNotification, packageKind
+from shared.codec import CODEC_JSON, getCodec
+from timeit import default_timer
+import binascii, json, os
 
 class CMServerFactory(Factory):
     """
@@ -9,72 +19,478 @@ class CMServerFactory(Factory):
 
         Args:
             protocol    (obj)   :   The Server Protocol.
-            connections (list)  :   A list of current connections
-            channels    (list)  :   A list of current channels.
+            connections (set)   :   The current connections.
+            channels    (dict)  :   The current channels, keyed by name,
+                                    see Channel.
+            lobby       (set)   :   The connections outside of a channel.
+            publicChannels (list):  The names of the public channels, as
+                                    sent in the channel list, once built.
+            channelListPayloads (dict): The encoded packages carrying the
+                                        channel list, keyed by their kind
+                                        and codec, see channelListPayload().
+            users       (dict)  :   The logged in connections, keyed by
+                                    username.
+            bus         (obj)   :   The room bus, when running as one of
+                                    several worker processes.
+            historyLength (int) :   The number of messages kept per channel.
+            historyMaxBytes (int):  The size of the messages kept per channel.
+            messageLog  (obj)   :   The durable message log, if enabled.
+            maxHistoryQuery (int):  The most messages a history query returns.
+            outputHighWatermark (int):  The bytes queued for a slow client
+                                        at which the output policies apply.
+            outputLowWatermark (int):   The bytes dropping old messages
+                                        for a slow client stops at.
+            outputPolicies (dict):  The output policy of each kind of
+                                    package, see OutputQueue.
+            clock       (obj)   :   The clock scheduling timed work, the
+                                    reactor unless running on another
+                                    event loop.
+            presence    (obj)   :   The aggregator batching the joins,
+                                    leaves and renames of each channel.
+            presenceInterval (float):   The seconds presence changes are
+                                        collected for before being sent.
+            metrics     (obj)   :   The counters of the server.
+            heartbeat   (obj)   :   The timer wheel checking connections
+                                    for inactivity.
+            idleTimeout (float) :   The seconds of silence after which a
+                                    connection is pinged.
+            pingTimeout (float) :   The seconds a pinged connection has to
+                                    answer before it is dropped.
+            messageRate (float) :   The messages per second a connection
+                                    may send, or None for no limit.
+            messageBurst (int)  :   The messages a connection may send at
+                                    once, after being quiet.
+            channelMessageRate (float): The messages per second routed to
+                                        a channel, or None for no limit.
+            channelMessageBurst (int):  The messages routed to a channel
+                                        at once, after being quiet.
+            flushInterval (float):  The seconds outgoing frames may be held
+                                    back, to be written together, 0 for
+                                    the next reactor tick, or None to
+                                    write every frame right away.
+            flushBytes  (int)   :   The pending bytes at which a connection
+                                    is flushed without waiting.
+            pendingFlush (set)  :   The connections with pending frames.
+            resumeTimeout (float):  The seconds a lost session can be
+                                    resumed for.
+            resumable   (dict)  :   The username, channel, channel creation
+                                    time, sequence number of the channel and
+                                    expiry time of every lost session,
+                                    keyed by resume token.
+            resumeWheel (obj)   :   The timer wheel expiring lost sessions.
+            flushCall   (obj)   :   The timer of the next flush, if any.
     """
 
     protocol    = CMServer
-    connections = []
-    channels    = []
+    connections = set()
+    channels    = {}
+    lobby       = set()
+    publicChannels      = None
+    channelListPayloads = {}
+    users       = {}
+    bus         = None
+    historyLength   = 50
+    historyMaxBytes = 64 * 1024
+    messageLog  = None
+    maxHistoryQuery = 200
+    outputHighWatermark = 256 * 1024
+    outputLowWatermark  = 64 * 1024
+    outputPolicies      = None
+    clock       = reactor
+    presence    = None
+    presenceInterval    = 0.1
+    metrics     = None
+    heartbeat   = None
+    idleTimeout = 60.0
+    pingTimeout = 15.0
+    messageRate     = 5.0
+    messageBurst    = 10
+    channelMessageRate  = 100.0
+    channelMessageBurst = 200
+    flushInterval   = None
+    flushBytes      = 64 * 1024
+    pendingFlush    = set()
+    flushCall       = None
+    resumeTimeout   = 120.0
+    resumable       = {}
+    resumeWheel     = None
     defaultChannels = ["general", "python"]
 
-    def __init__(self):
-        self.channels = self.defaultChannels[:]
+    def __init__(self, messageLog=None, clock=None):
+        self.messageLog = messageLog
+        if clock is not None:
+            self.clock = clock
+        self.connections = set()
+        self.lobby = set()
+        self.users = {}
+        self.channels = {}
+        for name in self.defaultChannels:
+            self.channels[name] = Channel(name, self.clock.seconds(), persistent=True)
+        self.channelListPayloads = {}
+        self.pendingFlush = set()
+        self.presence = PresenceAggregator(self, self.clock, self.presenceInterval)
+        self.metrics = Metrics()
+        self.heartbeat = TimerWheel(self.clock, self.checkIdle)
+        self.resumable = {}
+        self.resumeWheel = TimerWheel(self.clock, self.__expireSession)
 
     def addConnection(self, connection):
         """
-            Add a connection to the connections list.
+            Add a connection to the connections set.
 
             Args:
                 connection (obj) : A new connection.
         """
-        self.connections.append(connection)
+        self.connections.add(connection)
+        self.lobby.add(connection)
+        self.metrics.connectionsOpened += 1
+        self.heartbeat.schedule(connection, self.idleTimeout)
 
     def removeConnection(self, connection):
         """
-            Remove a connection from the connections list.
+            Remove a connection from the connections set.
+
+            Note:
+                The session of a logged in connection is kept for
+                resumeTimeout seconds, see resumeSession().
 
             Args:
                 connection (obj) : The connection to remove.
         """
-        self.connections.remove(connection)
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        self.lobby.discard(connection)
+        self.metrics.connectionsClosed += 1
+        self.heartbeat.cancel(connection)
+        self.pendingFlush.discard(connection)
+        # The username is released even if the rest of the cleanup
+        # fails, so that it can never stay reserved.
+        try:
+            self.__keepSession(connection)
+            self.__removeMember(connection.session.channel, connection)
+        finally:
+            self.releaseUsername(connection.session.username, connection)
 
-    def didJoinChannel(self, channel, username):
+    def checkIdle(self, connection):
         """
-            Called when a user joins a channel.
+            Called by the heartbeat wheel once a connection may have
+            gone quiet.
+
+            A connection silent for idleTimeout seconds is pinged, and
+            dropped if it is still silent pingTimeout seconds later.
+            This frees the username and the broadcasts from peers that
+            went away without closing the connection.
 
-            Should check if channel exists in the channels list. If
-            not, add it.
+            Args:
+                connection (obj)    :   The connection to check.
         """
-        users = []
-        if not channel in self.channels:
-            self.channels.append(channel)
-            users.append(username)
+        if connection not in self.connections:
+            return
+        idle = self.clock.seconds() - connection.session.lastActivity
+        if idle < self.idleTimeout:
+            self.heartbeat.schedule(connection, self.idleTimeout - idle)
+        elif not connection.session.awaitingPong:
+            connection.session.awaitingPong = True
+            connection.sendPing()
+            self.heartbeat.schedule(connection, self.pingTimeout)
         else:
-            for connection in self.connections:
-                if connection.channel == channel:
-                    users.append(connection.username)
+            self.metrics.connectionsReaped += 1
+            connection.dropConnection()
+
+    def newResumeToken(self):
+        """
+            Returns:
+                A new, unguessable, session resume token.
+        """
+        return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+    def takeOverSession(self, username, token):
+        """
+            Drops the connection a session belongs to, if it is still
+            open, so that a client reconnecting before the server has
+            noticed the old connection is gone gets its username back.
+
+            Note:
+                Only a connection on this worker can be taken over. One
+                on another worker holds the username until it is reaped
+                by the heartbeat.
+
+            Args:
+                username (str)  :   The username of the session.
+                token (str)     :   The resume token of the session.
+        """
+        connection = self.users.get(username)
+        if connection is None or connection.session.resumeToken != token:
+            return
+        self.removeConnection(connection)
+        channel = connection.session.channel
+        if channel is not None:
+            connection.session.channel = None
+            self.didLeaveChannel(channel, connection)
+        connection.dropConnection()
+
+    def resumeSession(self, username, token, seen=None):
+        """
+            Resumes a lost session.
+
+            Note:
+                The messages missed are counted from the sequence number
+                of the last message the client has seen. Without it, they
+                are counted from when the server noticed the connection
+                was lost, which misses those sent to a half-open
+                connection.
+
+            Args:
+                username (str)  :   The username of the session.
+                token (str)     :   The resume token of the session.
+                seen (int)      :   The sequence number of the last
+                                    message the client received.
+
+            Returns:
+                None if there is no such session, otherwise the channel
+                the user was in, or None, and the number of messages
+                sent to it since.
+        """
+        entry = self.resumable.pop(token, None)
+        if entry is None:
+            return None
+        self.resumeWheel.cancel(token)
+        entryUsername, channel, created, messages, expiresAt = entry
+        if entryUsername != username:
+            return None
+        if channel is None:
+            return None, 0
+        current = self.channels.get(channel)
+        if current is None:
+            return channel, 0
+        if current.created != created:
+            # The channel was emptied and made anew.
+            messages = 0
+        elif isinstance(seen, int) and 0 <= seen <= current.messages:
+            messages = seen
+        return channel, max(current.messages - messages, 0)
+
+    def scheduleFlush(self, connection):
+        """
+            Schedules the pending frames of a connection to be written
+            with the next flush.
+
+            Note:
+                A single timer flushes every connection, however many
+                have frames pending.
+
+            Args:
+                connection (obj)    :   The connection.
+        """
+        self.pendingFlush.add(connection)
+        if self.flushCall is None:
+            self.flushCall = self.clock.callLater(self.flushInterval, self.flushWrites)
+
+    def flushWrites(self):
+        """
+            Writes the pending frames of every connection.
+        """
+        self.flushCall = None
+        connections = self.pendingFlush
+        self.pendingFlush = set()
+        for connection in connections:
+            connection.flushFrames()
+
+    def newMessageBucket(self):
+        """
+            Returns:
+                The rate limit of a new connection's messages, or None.
+        """
+        if self.messageRate is None:
+            return None
+        return TokenBucket(self.messageRate, self.messageBurst, self.clock.seconds())
+
+    def allowMessage(self, connection):
+        """
+            Checks the rate limits of a connection and of its channel,
+            before a message from it is routed.
+
+            Note:
+                A message refused by the channel still takes a token
+                from the connection, so that a spammer can not use up
+                the channel's share.
+
+            Args:
+                connection (obj)    :   The connection sending a message.
+
+            Returns:
+                None if the message is allowed, otherwise the reason
+                it is not.
+        """
+        now = self.clock.seconds()
+        session = connection.session
+        bucket = session.messageBucket
+        if bucket is not None and not bucket.consume(now):
+            return "You are sending messages too fast."
+        channel = self.channels.get(session.channel)
+        if channel is None or self.channelMessageRate is None:
+            return None
+        bucket = channel.bucket
+        if bucket is None:
+            bucket = channel.bucket = TokenBucket(self.channelMessageRate, self.channelMessageBurst, now)
+        if not bucket.consume(now):
+            return "The channel is too busy, try again in a moment."
+        return None
+
+    def membersOf(self, channel):
+        """
+            Returns the connections inside a channel.
+
+            Note:
+                The connections that have not joined a channel are
+                returned for None.
 
-        self.sendNotification("user_joined", channel, {"channel": channel, "username": username, "current_users": users})
+            Args:
+                channel (str)   :   The channel.
+
+            Returns:
+                A collection of connections.
+        """
+        if channel is None:
+            return self.lobby
+        channel = self.channels.get(channel)
+        if channel is None:
+            return ()
+        return channel.members
 
-    def didLeaveChannel(self, channel, username):
+    def channelList(self):
+        """
+            Returns:
+                The names of the public channels.
+
+            Note:
+                The list is built once, and kept until a channel is
+                created, removed or changes visibility. It must not be
+                changed by the caller.
+        """
+        channels = self.publicChannels
+        if channels is None:
+            channels = self.publicChannels = sorted(name for name, channel in self.channels.items() if channel.public)
+        return channels
+
+    def channelListPayload(self, codec):
+        """
+            Returns the channel_list notification, encoded with a codec.
+
+            Args:
+                codec (obj) :   The codec.
+        """
+        key = ("channel_list", codec.name)
+        payload = self.channelListPayloads.get(key)
+        if payload is None:
+            package = newNotification("channel_list", {"channels": self.channelList()})
+            payload = self.channelListPayloads[key] = codec.encode(package)
+        return payload
+
+    def sessionPayload(self, codec, compression=None, codecName=None):
+        """
+            Returns the session package of a successful login, encoded
+            with a codec.
+
+            Note:
+                Logins are answered with the same few packages, so that
+                a login storm encodes the channel list once rather than
+                once per connection.
+
+            Args:
+                codec (obj)         :   The codec the package is sent with.
+                compression (str)   :   The compression method accepted, if any.
+                codecName (str)     :   The codec accepted, if not JSON.
+        """
+        key = ("session", codec.name, compression, codecName)
+        payload = self.channelListPayloads.get(key)
+        if payload is None:
+            data = {"status": True, "channels": self.channelList()}
+            if compression is not None:
+                data["compression"] = compression
+            if codecName is not None:
+                data["codec"] = codecName
+            payload = self.channelListPayloads[key] = codec.encode(newPackage("session", data))
+        return payload
+
+    def setChannelVisibility(self, channel, public, username=None):
+        """
+            Lists a channel in the channel list, or hides it.
+
+            The users inside the channel are sent a channel_visibility
+            notification. When running as a worker, the other workers
+            are told through the room bus.
+
+            Args:
+                channel (str)   :   The channel.
+                public (bool)   :   Whether the channel is listed.
+                username (str)  :   The user that changed it.
+        """
+        self.didChangeVisibility(channel, public)
+        if self.bus is not None:
+            self.bus.setVisibility(channel, public)
+        self.sendNotification("channel_visibility", channel, {"channel": channel, "public": public, "username": username})
+
+    def usersInChannel(self, channel):
+        """
+            Returns the usernames of the users inside a channel.
+
+            Args:
+                channel (str)   :   The channel.
+        """
+        channel = self.channels.get(channel)
+        if channel is None:
+            return []
+        return channel.usernames()
+
+    def didJoinChannel(self, channel, connection, replay=True):
+        """
+            Called when a user joins a channel.
+
+            The channel is created if it does not exist. The recent
+            messages of the channel are replayed to the user in one
+            write, followed by the users inside it. The other users
+            learn about the join with the next presence notification
+            of the channel.
+
+            Args:
+                channel (str)       :   The channel joined.
+                connection (obj)    :   The connection that joined.
+                replay (bool)       :   Whether to replay the recent messages.
+        """
+        self.lobby.discard(connection)
+        self.__openChannel(channel).members.add(connection)
+        if self.bus is not None:
+            self.bus.join(channel, connection.session.username)
+        history = self.channels[channel].history
+        if history and replay:
+            connection.sendPayloads(history)
+        self.sendUserList(connection, channel)
+        self.presence.didJoin(channel, connection.session.username)
+
+    def didLeaveChannel(self, channel, connection):
         """
             Called when a user leaves a channel.
 
-            Should check if the channel is empty. If so, remove it
-            from the channels list.
-        """
-        users = []
-        for connection in self.connections:
-            # Check if the channel is empty
-            if connection.channel == channel:
-                users.append(connection.username)
-        if len(users) > 0:
-            # Notify the users in the channel and send an updated users list
-            self.sendNotification("user_left", channel, {"channel": channel, "username": username, "current_users": users})
-        elif channel not in self.defaultChannels and channel in self.channels:
-            # Remove the channel if no one is inside
-            self.channels.remove(channel)
+            A channel left empty is removed, unless it is one of the
+            default channels.
+
+            Args:
+                channel (str)       :   The channel left.
+                connection (obj)    :   The connection that left.
+        """
+        self.__removeMember(channel, connection)
+        if connection in self.connections:
+            self.lobby.add(connection)
+        if self.bus is not None:
+            self.bus.leave(channel, connection.session.username)
+
+        if not self.__isEmpty(channel):
+            self.presence.didLeave(channel, connection.session.username)
+        else:
+            self.presence.discard(channel)
+            self.__removeChannelIfEmpty(channel)
 
     def isUsernameUnique(self, username):
         """
@@ -90,32 +506,142 @@ class CMServerFactory(Factory):
                 A boolean indicating whether the username is
                 already in use or not.
         """
-        for conn in self.connections:
-            if username == conn.username:
-                return False
+        return username not in self.users
+
+    def reserveUsername(self, username, connection):
+        """
+            Claims a username for a connection on this server.
+
+            Note:
+                Checking and claiming happens in one step, so two
+                connections can never end up with the same username.
+                When running as a worker, use claimUsername() instead,
+                which also claims the username on the other workers.
+
+            Args:
+                username (str)      :   The username to claim.
+                connection (obj)    :   The connection claiming it.
+
+            Returns:
+                True if the username was free, or already belongs to
+                the connection, otherwise False.
+        """
+        owner = self.users.get(username)
+        if owner is not None and owner is not connection:
+            return False
+        self.users[username] = connection
         return True
 
-    def sendMessage(self, message, username, toChannel=None):
+    def claimUsername(self, username, connection):
+        """
+            Claims a username for a connection on every worker.
+
+            The username is first reserved locally, and then, when
+            running as a worker, with the room bus.
+
+            Args:
+                username (str)      :   The username to claim.
+                connection (obj)    :   The connection claiming it.
+
+            Returns:
+                A Deferred firing with True if the username was claimed.
+        """
+        if not self.reserveUsername(username, connection):
+            return defer.succeed(False)
+        if self.bus is None:
+            return defer.succeed(True)
+
+        def didClaim(granted):
+            if not granted and self.users.get(username) is connection:
+                del self.users[username]
+            return granted
+        return self.bus.claim(username).addCallback(didClaim)
+
+    def releaseUsername(self, username, connection):
+        """
+            Releases a username claimed by a connection.
+
+            Args:
+                username (str)      :   The username to release.
+                connection (obj)    :   The connection releasing it.
+        """
+        if username is not None and self.users.get(username) is connection:
+            del self.users[username]
+            if self.bus is not None:
+                self.bus.release(username)
+
+    def renameUser(self, connection, username):
+        """
+            Changes the username of a connection.
+
+            The renamed user is sent a user_rename notification right
+            away. The other users in the same channel learn about it
+            with the next presence notification of the channel.
+
+            Args:
+                connection (obj)    :   The connection to rename.
+                username (str)      :   The new username.
+
+            Returns:
+                A Deferred firing with a boolean indicating whether the
+                username was changed.
+        """
+        def didClaim(granted):
+            if not granted:
+                return False
+            if connection not in self.connections:
+                self.releaseUsername(username, connection)
+                return False
+            oldUsername = connection.session.username
+            self.releaseUsername(oldUsername, connection)
+            connection.session.username = username
+
+            connection.sendNotification("user_rename", {"old_username": oldUsername, "new_username": username})
+            channel = connection.session.channel
+            if channel is not None:
+                if self.bus is not None:
+                    self.bus.rename(channel, oldUsername, username)
+                self.presence.didRename(channel, oldUsername, username)
+            return True
+        return self.claimUsername(username, connection).addCallback(didClaim)
+
+    def sendUserList(self, connection, channel=None):
+        """
+            Sends a connection the full list of users inside its channel,
+            as of the last presence notification of the channel.
+
+            Args:
+                connection (obj)    :   The connection.
+                channel (str)       :   The channel, if not yet the one
+                                        of the connection.
+        """
+        if channel is None:
+            channel = connection.session.channel
+        users = self.presence.announcedUsers(channel, self.usersInChannel(channel))
+        seq = self.channels[channel].messages if channel in self.channels else 0
+        connection.sendNotification("user_list", {"channel": channel, "current_users": users, "seq": seq})
+
+    def sendMessage(self, message, sender, toChannel=None):
         """
             Send a message to the users in a specific channel.
 
             Note:
-                Method should check the which channel the connections
-                (i.e. protocol objects) are inside, and only send
-                to the ones inside that channel.
-
-                A None value should route the message to users in
-                the general channel.
+                The message is routed to the members of the channel,
+                except the sending connection. Connections that have
+                not joined a channel are indexed under None. A message
+                to a channel carries its sequence number in the channel.
 
             Args:
-                message (json)  :   The message to send.
+                message (str)   :   The message to send.
+                sender (obj)    :   The connection that sent the message.
                 toChannel  (str):   The channel the message should
                                     be routed to.
         """
-        users = self.connections
-        for conn in users:
-            if toChannel == conn.channel and username != conn.username:
-                conn.sendMessage(message, username)
+        package = newMessage(message, sender.session.username)
+        channel = self.channels.get(toChannel)
+        if channel is not None:
+            package["data"]["seq"] = channel.messages + 1
+        self.broadcast(package, toChannel, exclude=sender, record=True)
 
     def sendNotification(self, event_type, toChannel=None, parameters=[]):
         """
@@ -123,11 +649,318 @@ class CMServerFactory(Factory):
 
             Args:
                 event_type (str):   The event type.
-                username (str)  :   The user that triggered the notification
                 toChannel  (str):   The channel the message should be routed to.
+                parameters (dict):  The event parameters.
+        """
+        self.broadcast(newNotification(event_type, parameters), toChannel)
+
+    def commandStatistics(self):
+        """
+            Returns:
+                The number of calls and time spent per package type and
+                command, as collected by the protocol's dispatcher.
+        """
+        return self.protocol.dispatcher.callStatistics()
+
+    def broadcast(self, package, toChannel=None, exclude=None, record=False):
+        """
+            Send a package to every user in a channel.
+
+            Note:
+                The package is encoded once per codec, and framed once
+                per codec and framing mode in use. Every recipient is
+                handed the very same frame, except on compressed
+                connections, which compress the payload with their own
+                stream. The JSON encoding is the one kept in the history
+                and relayed to the other workers, and is only made when
+                one of them, or a recipient, needs it.
+
+            Args:
+                package (dict)  :   The package to send.
+                toChannel (str) :   The channel to route the package to.
+                exclude (obj)   :   A connection that should not receive
+                                    the package, usually the sender.
+                record (bool)   :   Whether to keep the package in the
+                                    history of the channel.
+        """
+        payload = None
+        if record or self.bus is not None:
+            start = default_timer()
+            payload = getCodec(CODEC_JSON).encode(package)
+            self.metrics.encodeLatency.observe(default_timer() - start)
+        kind = packageKind(package)
+        self.deliverPayload(payload, toChannel, exclude, kind, package)
+        if record:
+            self.recordPayload(payload, toChannel)
+            if self.messageLog is not None and toChannel is not None:
+                self.messageLog.append(toChannel, payload)
+        if self.bus is not None:
+            self.bus.publish(toChannel, payload, record, kind)
+
+    def recordPayload(self, payload, toChannel):
+        """
+            Keeps an encoded package in the history of a channel.
+
+            Note:
+                Messages outside of a channel are not kept.
+
+            Args:
+                payload (str)   :   The encoded package.
+                toChannel (str) :   The channel.
+        """
+        channel = self.channels.get(toChannel)
+        if channel is None:
+            return
+        history = channel.history
+        if history is None:
+            history = channel.history = ChannelHistory(self.historyLength, self.historyMaxBytes)
+        history.append(payload)
+        channel.messages += 1
+
+    def queryHistory(self, channel, count=None, since=None):
+        """
+            Looks up earlier messages of a channel.
+
+            Note:
+                Without a message log, the recent history kept in
+                memory is used, and the since argument is ignored.
+
+            Args:
+                channel (str)   :   The channel.
+                count (int)     :   The number of messages to return.
+                since (float)   :   Return the messages sent since this
+                                    timestamp instead.
+
+            Returns:
+                A Deferred firing with the encoded messages, oldest first.
+        """
+        if count is None or count > self.maxHistoryQuery:
+            count = self.maxHistoryQuery
+        if self.messageLog is not None:
+            if since is not None:
+                return self.messageLog.since(channel, since, count)
+            return self.messageLog.last(channel, count)
+        channel = self.channels.get(channel)
+        history = list(channel.history or ()) if channel is not None else []
+        return defer.succeed(history[-count:] if count > 0 else [])
+
+    def deliverPayload(self, payload, toChannel=None, exclude=None, kind=None, package=None):
         """
-        for conn in self.connections:
-            if toChannel == conn.channel:
-                conn.sendNotification(event_type, parameters)
+            Send an encoded package to the local users in a channel.
 
-    # TODO: Abstrahera mera. sendMessage och sendNotification har mycket gemensamt.
+            Note:
+                Compressed connections, and slow clients with packages
+                waiting, are handed the payload rather than the frame.
+                The package is encoded with the codec of each
+                connection at most once per codec, and only for the
+                codecs in use.
+
+            Args:
+                payload (str)   :   The JSON encoded package, or None if
+                                    not made yet, in which case the
+                                    package must be given.
+                toChannel (str) :   The channel to route the package to.
+                exclude (obj)   :   A connection that should not receive
+                                    the package.
+                kind (str)      :   The kind of package, see packageKind().
+                package (dict)  :   The package, if at hand, saving a
+                                    decode when another codec is in use.
+        """
+        payloads = {CODEC_JSON: payload} if payload is not None else {}
+        frames = {}
+        recipients = framed = 0
+        for conn in self.membersOf(toChannel):
+            if conn is exclude:
+                continue
+            recipients += 1
+            codec = conn.session.codec
+            encoded = payloads.get(codec.name)
+            if encoded is None:
+                if package is None:
+                    package = json.loads(payload)
+                start = default_timer()
+                encoded = payloads[codec.name] = codec.encode(package)
+                self.metrics.encodeLatency.observe(default_timer() - start)
+            if conn.session.compressor is not None or conn.isBlocked():
+                conn.sendPayload(encoded, kind)
+                continue
+            key = (codec.name, conn.frameBuffer.mode)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = conn.frameBuffer.encode(encoded)
+            conn.sendFrame(frame)
+            framed += 1
+        metrics = self.metrics
+        metrics.fanout.observe(recipients)
+        if framed:
+            metrics.didSendPackages(kind, framed)
+
+    ##########################
+    #   Room bus events
+    ##########################
+
+    def didReceiveRemotePayload(self, payload, toChannel, record, kind=None):
+        """
+            Called when a package is published on another worker.
+
+            Note:
+                A message kept in the history is given the sequence
+                number of the channel on this worker, which is the one
+                the local users resume from.
+
+            Args:
+                payload (str)   :   The JSON encoded package.
+                toChannel (str) :   The channel it was sent to.
+                record (bool)   :   Whether to keep it in the history.
+                kind (str)      :   The kind of package, see packageKind().
+        """
+        package = None
+        channel = self.channels.get(toChannel)
+        if record and channel is not None:
+            package = json.loads(payload)
+            seq = channel.messages + 1
+            data = package.get("data")
+            if isinstance(data, dict) and "seq" in data and data["seq"] != seq:
+                data["seq"] = seq
+                payload = getCodec(CODEC_JSON).encode(package)
+        self.deliverPayload(payload, toChannel, kind=kind, package=package)
+        if record:
+            self.recordPayload(payload, toChannel)
+
+    def didJoinRemoteChannel(self, channel, username, worker):
+        """
+            Called when a user on another worker joins a channel.
+        """
+        self.__openChannel(channel).remoteMembers[username] = worker
+
+    def didLeaveRemoteChannel(self, channel, username):
+        """
+            Called when a user on another worker leaves a channel.
+        """
+        channel = self.channels.get(channel)
+        if channel is not None:
+            channel.remoteMembers.pop(username, None)
+            self.__removeChannelIfEmpty(channel.name)
+
+    def didRenameRemoteUser(self, channel, oldUsername, username, worker):
+        """
+            Called when a user on another worker changes username.
+        """
+        channel = self.channels.get(channel)
+        if channel is not None and channel.remoteMembers.pop(oldUsername, None) is not None:
+            channel.remoteMembers[username] = worker
+
+    def didChangeVisibility(self, channel, public):
+        """
+            Called when a channel has been made public or private, on
+            this server or on another worker.
+        """
+        channel = self.channels.get(channel)
+        if channel is not None and channel.public != public:
+            channel.public = public
+            self.__invalidateChannelList()
+
+    def didLoseRemoteWorker(self, worker):
+        """
+            Called when another worker has gone away. Its users are
+            dropped from the channels.
+        """
+        for channel in list(self.channels.values()):
+            users = channel.remoteMembers
+            if not users:
+                continue
+            for username, owner in list(users.items()):
+                if owner == worker:
+                    del users[username]
+            if not users:
+                self.__removeChannelIfEmpty(channel.name)
+
+    def didLoseBus(self):
+        """
+            Called when the connection to the room bus is lost. The
+            server carries on with its local users only.
+        """
+        self.bus = None
+        for channel in list(self.channels.values()):
+            if channel.remoteMembers:
+                channel.remoteMembers = {}
+                self.__removeChannelIfEmpty(channel.name)
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __keepSession(self, connection):
+        """
+            Keeps the session of a lost connection, for it to be resumed.
+        """
+        session = connection.session
+        if session.username is None or session.resumeToken is None:
+            return
+        channel = self.channels.get(session.channel)
+        if channel is None:
+            entry = (session.username, None, None, 0)
+        else:
+            entry = (session.username, channel.name, channel.created, channel.messages)
+        self.resumable[session.resumeToken] = entry + (self.clock.seconds() + self.resumeTimeout,)
+        self.resumeWheel.schedule(session.resumeToken, self.resumeTimeout)
+
+    def __expireSession(self, token):
+        """
+            Called by the resume wheel once a lost session may have expired.
+        """
+        entry = self.resumable.get(token)
+        if entry is None:
+            return
+        remaining = entry[-1] - self.clock.seconds()
+        if remaining > 0:
+            self.resumeWheel.schedule(token, remaining)
+        else:
+            del self.resumable[token]
+
+    def __openChannel(self, name):
+        """
+            Returns a channel, creating it if needed.
+        """
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = Channel(name, self.clock.seconds())
+            self.__invalidateChannelList()
+        return channel
+
+    def __invalidateChannelList(self):
+        """
+            Drops the channel list and the packages carrying it, once
+            the channels have changed.
+        """
+        self.publicChannels = None
+        self.channelListPayloads = {}
+
+    def __isEmpty(self, name):
+        """
+            Returns:
+                True if nobody is inside a channel, or it does not exist.
+        """
+        channel = self.channels.get(name)
+        return channel is None or channel.isEmpty()
+
+    def __removeChannelIfEmpty(self, name):
+        """
+            Removes a channel nobody is inside, along with its history,
+            unless it is one of the default channels.
+        """
+        channel = self.channels.get(name)
+        if channel is None or not channel.isEmpty():
+            return
+        channel.bucket = None
+        if not channel.persistent:
+            del self.channels[name]
+            self.__invalidateChannelList()
+
+    def __removeMember(self, channel, connection):
+        """
+            Removes a connection from the members of a channel.
+        """
+        channel = self.channels.get(channel)
+        if channel is not None:
+            channel.members.discard(connection)
@@ -0,0 +1,153 @@
+from timeit import default_timer
+from core.metrics import Histogram, LATENCY_BUCKETS
+
+try:
+    stringTypes = basestring
+except NameError:
+    stringTypes = str
+
+class DispatchError(Exception):
+    """
+        Raised when a package can not be dispatched.
+
+        Args:
+            errorType (str) :   The error type, matching the command.
+            message (str)   :   A message describing the error.
+    """
+
+    def __init__(self, errorType, message):
+        super(DispatchError, self).__init__(message)
+        self.errorType = errorType
+        self.message = message
+
+class Dispatcher(object):
+    """
+        Routes incoming packages to their handlers.
+
+        Handlers are registered for a package type, and for command
+        packages also a command name, and are looked up with a single
+        dictionary access. Every handler can list the parameters it
+        requires, optionally with their type, which are checked before
+        the handler is called.
+
+        Note:
+            Handlers are called with the protocol and the parameters of
+            the package. For command packages the parameters are the
+            "parameters" attribute, otherwise the "data" attribute.
+
+        Args:
+            handlers (dict)     :   The handlers and required parameters,
+                                    keyed by (type, command).
+            statistics (dict)   :   The number of calls and the time spent
+                                    in each handler, keyed by (type, command).
+            latency (obj)       :   The histogram of the time spent in the
+                                    handlers.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.statistics = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    def handler(self, packageType, command=None, parameters=()):
+        """
+            Returns a decorator registering a handler.
+
+            Args:
+                packageType (str)   :   The package type to handle.
+                command (str)       :   The command to handle, if any.
+                parameters (list)   :   The parameters required, each a
+                                        name or a (name, type) tuple.
+        """
+        required = tuple(parameter if isinstance(parameter, tuple) else (parameter, None) for parameter in parameters)
+        def register(method):
+            key = (packageType, command)
+            self.handlers[key] = (method, required)
+            self.statistics[key] = [0, 0.0]
+            return method
+        return register
+
+    def command(self, command, parameters=()):
+        """
+            Returns a decorator registering a command handler.
+
+            Args:
+                command (str)       :   The command to handle.
+                parameters (list)   :   The parameters required, see handler().
+        """
+        return self.handler("command", command, parameters)
+
+    def dispatch(self, protocol, package):
+        """
+            Dispatches a package to its handler.
+
+            Note:
+                Packages of unknown types, and malformed packages, are
+                ignored, while unknown commands, and missing, malformed
+                or mistyped parameters, raise a DispatchError.
+
+            Args:
+                protocol (obj)  :   The protocol that received the package.
+                package (dict)  :   The package.
+        """
+        if not isinstance(package, dict):
+            return
+        packageType = package.get("type")
+        data = package.get("data")
+        if data is None:
+            data = {}
+        if not isinstance(packageType, stringTypes) or not isinstance(data, dict):
+            return
+        if packageType == "command":
+            command = data.get("command")
+            if not isinstance(command, stringTypes):
+                return
+            parameters = data.get("parameters")
+            if parameters is None:
+                parameters = {}
+        else:
+            command = None
+            parameters = data
+
+        key = (packageType, command)
+        entry = self.handlers.get(key)
+        if entry is None:
+            if command is not None:
+                raise DispatchError(command, "Unknown command %s." % command)
+            return
+
+        method, required = entry
+        if not isinstance(parameters, dict):
+            raise DispatchError(command or packageType, "Malformed parameters.")
+        for name, parameterType in required:
+            if name not in parameters:
+                raise DispatchError(command or packageType, "Missing parameter %s." % name)
+            if parameterType is not None and not isinstance(parameters[name], parameterType):
+                raise DispatchError(command or packageType, "Invalid parameter %s." % name)
+
+        start = default_timer()
+        try:
+            method(protocol, parameters)
+        finally:
+            elapsed = default_timer() - start
+            statistics = self.statistics[key]
+            statistics[0] += 1
+            statistics[1] += elapsed
+            self.latency.observe(elapsed)
+
+    def callStatistics(self):
+        """
+            Returns:
+                A dictionary with the number of calls, and the total and
+                average time in seconds spent in each handler, keyed by
+                "type" or "type:command".
+        """
+        result = {}
+        for (packageType, command), (calls, seconds) in self.statistics.items():
+            name = packageType if command is None else "%s:%s" % (packageType, command)
+            result[name] = {
+                "calls": calls,
+                "seconds": seconds,
+                "average": seconds / calls if calls else 0.0
+            }
+        return result
@@ -0,0 +1,45 @@
+from collections import deque
+
+class ChannelHistory(object):
+    """
+        A bounded history of the messages sent to a channel.
+
+        The messages are kept as encoded packages, oldest first, so
+        that they can be replayed without being encoded again. The
+        oldest messages are dropped once either the number of messages
+        or their total size exceeds its limit.
+
+        Args:
+            maxLength (int) :   The largest number of messages kept.
+            maxBytes (int)  :   The largest total size of the messages kept.
+            size (int)      :   The current total size of the messages.
+    """
+
+    maxLength   = 50
+    maxBytes    = 64 * 1024
+
+    def __init__(self, maxLength=None, maxBytes=None):
+        if maxLength is not None:
+            self.maxLength = maxLength
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        self.payloads = deque()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def __iter__(self):
+        return iter(self.payloads)
+
+    def append(self, payload):
+        """
+            Adds a message to the history.
+
+            Args:
+                payload (str)   :   The encoded message package.
+        """
+        self.payloads.append(payload)
+        self.size += len(payload)
+        while self.payloads and (len(self.payloads) > self.maxLength or self.size > self.maxBytes):
+            self.size -= len(self.payloads.popleft())
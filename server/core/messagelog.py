@@ -0,0 +1,379 @@
+from twisted.internet import threads
+import binascii, bisect, mmap, os, struct, threading, time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+# Every message in a segment has a fixed size index record, holding
+# its timestamp, its offset in the log file and its length.
+INDEX_RECORD = struct.Struct("!dQI")
+
+# Fsync policies.
+SYNC_ALWAYS     = "always"
+SYNC_INTERVAL   = "interval"
+SYNC_NEVER      = "never"
+
+class Segment(object):
+    """
+        A segment of a channel log, made up of a log file with the
+        encoded messages and an index file with one record per message.
+
+        Note:
+            Segments are named after the sequence number of their first
+            message, padded to 20 digits so that they sort by name.
+
+        Args:
+            path (str)  :   The path of the segment, without extension.
+            first (int) :   The sequence number of the first message.
+    """
+
+    def __init__(self, directory, first):
+        self.path = os.path.join(directory, "%020d" % first)
+        self.first = first
+
+    @property
+    def logPath(self):
+        return self.path + ".log"
+
+    @property
+    def indexPath(self):
+        return self.path + ".idx"
+
+    def read(self, start=0, stop=None, since=None):
+        """
+            Reads messages from the segment, through memory maps.
+
+            Args:
+                start (int)     :   The position of the first message.
+                stop (int)      :   The position after the last message.
+                since (float)   :   Skip messages older than this timestamp.
+
+            Returns:
+                A list of encoded messages.
+        """
+        index = self.__map(self.indexPath)
+        if index is None:
+            return []
+        try:
+            count = len(index) // INDEX_RECORD.size
+            stop = count if stop is None else min(stop, count)
+            if since is not None:
+                timestamps = IndexTimestamps(index, count)
+                start = max(start, bisect.bisect_left(timestamps, since))
+            if start >= stop:
+                return []
+            log = self.__map(self.logPath)
+            if log is None:
+                return []
+            try:
+                payloads = []
+                for position in range(start, stop):
+                    _, offset, length = INDEX_RECORD.unpack_from(index, position * INDEX_RECORD.size)
+                    payloads.append(log[offset:offset + length])
+                return payloads
+            finally:
+                log.close()
+        finally:
+            index.close()
+
+    def count(self):
+        """
+            Returns:
+                The number of complete index records.
+        """
+        if not os.path.exists(self.indexPath):
+            return 0
+        return os.path.getsize(self.indexPath) // INDEX_RECORD.size
+
+    def __map(self, path):
+        """
+            Maps a file into memory for reading, or returns None if it
+            is missing or empty.
+        """
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+
+class IndexTimestamps(object):
+    """
+        A read-only sequence view of the timestamps in a mapped index,
+        so that it can be searched with bisect.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        return INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)[0]
+
+class ChannelLog(object):
+    """
+        The append-only log of a single channel.
+
+        Note:
+            Only the writer thread appends to a channel log. Readers
+            may run concurrently on other threads, as a message is
+            written to the log file before its index record, and only
+            complete index records are ever read.
+
+        Args:
+            directory (str)     :   The directory of the channel.
+            segments (list)     :   The segments, oldest first.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".idx"))
+        self.segments = [Segment(directory, int(name[:-4])) for name in names]
+        self.logFile = None
+        self.indexFile = None
+
+    def last(self, count):
+        """
+            Returns:
+                The last count messages, oldest first.
+        """
+        payloads = []
+        for segment in reversed(list(self.segments)):
+            available = segment.count()
+            start = max(0, available - (count - len(payloads)))
+            payloads[0:0] = segment.read(start, available)
+            if len(payloads) >= count:
+                break
+        return payloads
+
+    def since(self, timestamp, limit):
+        """
+            Returns:
+                At most limit messages sent at or after the timestamp,
+                oldest first.
+        """
+        payloads = []
+        for segment in list(self.segments):
+            payloads.extend(segment.read(since=timestamp))
+            if len(payloads) >= limit:
+                return payloads[:limit]
+        return payloads
+
+    def append(self, timestamp, payload, segmentSize):
+        """
+            Appends a message, rotating to a new segment when the
+            current one has grown past the segment size.
+        """
+        if self.logFile is None:
+            self.__open()
+        offset = self.logFile.tell()
+        if offset >= segmentSize:
+            self.__rotate()
+            offset = 0
+        self.logFile.write(payload)
+        self.logFile.flush()
+        self.indexFile.write(INDEX_RECORD.pack(timestamp, offset, len(payload)))
+
+    def flush(self, sync):
+        """
+            Flushes the open files, and forces them to disk if sync is set.
+        """
+        if self.logFile is None:
+            return
+        self.indexFile.flush()
+        if sync:
+            os.fsync(self.logFile.fileno())
+            os.fsync(self.indexFile.fileno())
+
+    def close(self):
+        if self.logFile is not None:
+            self.flush(True)
+            self.logFile.close()
+            self.indexFile.close()
+            self.logFile = self.indexFile = None
+
+    def __open(self):
+        """
+            Opens the last segment for appending, after dropping any
+            half written record left behind by a crash.
+
+            Note:
+                The index may have reached the disk ahead of the log,
+                so records pointing past the end of the log file are
+                dropped too, rather than extending the log with zeros.
+        """
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+        segment = self.segments[-1]
+        count = segment.count()
+        size = os.path.getsize(segment.logPath) if os.path.exists(segment.logPath) else 0
+        end = 0
+        if count > 0:
+            with open(segment.indexPath, "rb") as f:
+                while count > 0:
+                    f.seek((count - 1) * INDEX_RECORD.size)
+                    _, offset, length = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+                    if offset + length <= size:
+                        end = offset + length
+                        break
+                    count -= 1
+        self.logFile = open(segment.logPath, "ab")
+        self.indexFile = open(segment.indexPath, "ab")
+        self.logFile.truncate(end)
+        self.indexFile.truncate(count * INDEX_RECORD.size)
+        self.logFile.seek(end)
+        self.indexFile.seek(count * INDEX_RECORD.size)
+
+    def __rotate(self):
+        """
+            Closes the current segment and starts a new one.
+        """
+        segment = self.segments[-1]
+        self.close()
+        self.segments.append(Segment(self.directory, segment.first + segment.count()))
+        self.__open()
+
+class MessageLog(object):
+    """
+        A durable, append-only log of the messages sent to each channel.
+
+        Every channel has its own directory of segments. Appending only
+        queues the message, and a single writer thread writes the queue
+        in batches, so the reactor never waits on the disk. History
+        queries run on the reactor's thread pool, and read the segments
+        through memory maps, so only the messages asked for are loaded.
+
+        Args:
+            directory (str)     :   The directory of the log.
+            segmentSize (int)   :   The size at which a segment is rotated.
+            syncPolicy (str)    :   When to fsync: after every batch
+                                    ("always"), at most every syncInterval
+                                    seconds ("interval"), or "never".
+            syncInterval (float):   The seconds between fsyncs.
+    """
+
+    segmentSize     = 16 * 1024 * 1024
+    syncPolicy      = SYNC_INTERVAL
+    syncInterval    = 1.0
+
+    def __init__(self, directory, segmentSize=None, syncPolicy=None, syncInterval=None):
+        self.directory = directory
+        if segmentSize is not None:
+            self.segmentSize = segmentSize
+        if syncPolicy is not None:
+            self.syncPolicy = syncPolicy
+        if syncInterval is not None:
+            self.syncInterval = syncInterval
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.lastSync = time.time()
+        self.writer = threading.Thread(target=self.__write, name="MessageLog")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, channel, payload):
+        """
+            Queues a message to be appended to the log of a channel.
+
+            Args:
+                channel (str)   :   The channel.
+                payload (str)   :   The encoded message package.
+        """
+        self.queue.put((channel, time.time(), payload))
+
+    def last(self, channel, count):
+        """
+            Reads the last messages of a channel.
+
+            Returns:
+                A Deferred firing with the encoded messages, oldest first.
+        """
+        return threads.deferToThread(lambda: self.__channelLog(channel).last(count))
+
+    def since(self, channel, timestamp, limit):
+        """
+            Reads the messages of a channel sent since a timestamp.
+
+            Returns:
+                A Deferred firing with the encoded messages, oldest first.
+        """
+        return threads.deferToThread(lambda: self.__channelLog(channel).since(timestamp, limit))
+
+    def close(self):
+        """
+            Writes what is left in the queue, and closes the log.
+        """
+        self.queue.put(None)
+        self.writer.join()
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __channelLog(self, channel):
+        """
+            Returns the log of a channel, opening it if needed.
+        """
+        with self.lock:
+            channelLog = self.channels.get(channel)
+            if channelLog is None:
+                name = binascii.hexlify(channel.encode("utf-8")).decode("ascii")
+                channelLog = self.channels[channel] = ChannelLog(os.path.join(self.directory, name))
+            return channelLog
+
+    def __write(self):
+        """
+            The writer thread. Writes the queued messages in batches,
+            and syncs according to the policy.
+        """
+        unsynced = set()
+        running = True
+        while running:
+            # Wake up in time for the next sync, if anything is waiting for one.
+            timeout = None
+            if unsynced and self.syncPolicy == SYNC_INTERVAL:
+                timeout = max(0.0, self.lastSync + self.syncInterval - time.time())
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except Empty:
+                batch = []
+            while not self.queue.empty():
+                batch.append(self.queue.get())
+
+            written = set()
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                channel, timestamp, payload = item
+                channelLog = self.__channelLog(channel)
+                channelLog.append(timestamp, payload, self.segmentSize)
+                written.add(channelLog)
+            for channelLog in written:
+                channelLog.flush(False)
+            unsynced.update(written)
+
+            now = time.time()
+            if self.syncPolicy == SYNC_ALWAYS:
+                sync = True
+            elif self.syncPolicy == SYNC_INTERVAL:
+                sync = now - self.lastSync >= self.syncInterval
+            else:
+                sync = False
+            if sync:
+                for channelLog in unsynced:
+                    channelLog.flush(True)
+                unsynced.clear()
+                self.lastSync = now
+
+        for channelLog in self.channels.values():
+            channelLog.close()
@@ -0,0 +1,210 @@
+from twisted.web.resource import Resource
+from bisect import bisect_left
+
+# The upper bounds of the histogram buckets.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+FANOUT_BUCKETS  = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Histogram(object):
+    """
+        A histogram with fixed buckets.
+
+        Note:
+            Only the bucket an observation falls into is counted, so
+            that observing is a search and an increment. The buckets
+            are made cumulative when rendered.
+
+        Args:
+            bounds (tuple)  :   The upper bounds of the buckets.
+            counts (list)   :   The observations per bucket, with a last
+                                one for those above every bound.
+            sum (float)     :   The sum of the observations.
+            count (int)     :   The number of observations.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, description):
+        """
+            Returns:
+                The lines of the histogram in the Prometheus text format.
+        """
+        lines = header(name, "histogram", description)
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append("%s_sum %s" % (name, self.sum))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+class Metrics(object):
+    """
+        The counters of a server.
+
+        The counters are plain attributes and dictionaries updated in
+        place on the hot paths. The reactor runs on a single thread, so
+        no locks are needed, and everything derived, such as the members
+        of each channel, is computed only when the metrics are rendered.
+
+        Note:
+            The packages received, and the time spent handling them, are
+            counted by the dispatcher, see Dispatcher.callStatistics().
+
+        Args:
+            packagesSent (dict)     :   The packages handed to a connection,
+                                        keyed by kind, see packageKind().
+            packagesDropped (dict)  :   The packages dropped or coalesced
+                                        while queued for a slow client,
+                                        keyed by kind.
+            bytesSent (int)         :   The bytes written to the clients.
+            bytesReceived (int)     :   The bytes received from the clients.
+            writes (int)            :   The writes handed to the transports.
+            connectionsOpened (int) :   The connections made.
+            connectionsClosed (int) :   The connections lost.
+            connectionsReaped (int) :   The connections dropped for not
+                                        answering a ping.
+            messagesLimited (int)   :   The messages refused by a rate limit.
+            fanout (obj)            :   The local recipients per broadcast.
+            encodeLatency (obj)     :   The seconds spent encoding a package.
+    """
+
+    def __init__(self):
+        self.packagesSent = {}
+        self.packagesDropped = {}
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.writes = 0
+        self.connectionsOpened = 0
+        self.connectionsClosed = 0
+        self.connectionsReaped = 0
+        self.messagesLimited = 0
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.encodeLatency = Histogram(LATENCY_BUCKETS)
+
+    def didSendPackages(self, kind, count=1):
+        """
+            Counts packages handed to connections.
+
+            Args:
+                kind (str)  :   The kind of package.
+                count (int) :   The number of recipients.
+        """
+        packagesSent = self.packagesSent
+        packagesSent[kind] = packagesSent.get(kind, 0) + count
+
+    def didDropPackages(self, kind, count=1):
+        """
+            Counts packages dropped from the output queue of a slow client.
+
+            Args:
+                kind (str)  :   The kind of package.
+                count (int) :   The number of packages dropped.
+        """
+        packagesDropped = self.packagesDropped
+        packagesDropped[kind] = packagesDropped.get(kind, 0) + count
+
+    def render(self, factory):
+        """
+            Renders the metrics of a server in the Prometheus text format.
+
+            Args:
+                factory (obj)   :   The server factory.
+
+            Returns:
+                The metrics, as text.
+        """
+        dispatcher = factory.protocol.dispatcher
+        statistics = sorted(dispatcher.statistics.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+
+        lines = header("chatmaster_packages_received_total", "counter", "Packages received, by type and command.")
+        for (packageType, command), (calls, seconds) in statistics:
+            lines.append('chatmaster_packages_received_total{type="%s",command="%s"} %d' % (escape(packageType), escape(command or ""), calls))
+        lines += header("chatmaster_dispatch_seconds_total", "counter", "Seconds spent handling packages, by type and command.")
+        for (packageType, command), (calls, seconds) in statistics:
+            lines.append('chatmaster_dispatch_seconds_total{type="%s",command="%s"} %s' % (escape(packageType), escape(command or ""), seconds))
+        lines.extend(dispatcher.latency.render("chatmaster_dispatch_seconds", "Seconds spent handling a package."))
+
+        lines += header("chatmaster_packages_sent_total", "counter", "Packages handed to a connection, by kind.")
+        for kind, count in sorted(self.packagesSent.items(), key=lambda item: item[0] or ""):
+            lines.append('chatmaster_packages_sent_total{kind="%s"} %d' % (escape(kind or ""), count))
+        lines += header("chatmaster_packages_dropped_total", "counter", "Packages dropped or coalesced while queued for a slow client, by kind.")
+        for kind, count in sorted(self.packagesDropped.items(), key=lambda item: item[0] or ""):
+            lines.append('chatmaster_packages_dropped_total{kind="%s"} %d' % (escape(kind or ""), count))
+        lines.extend(self.encodeLatency.render("chatmaster_encode_seconds", "Seconds spent encoding a package."))
+        lines.extend(self.fanout.render("chatmaster_fanout_recipients", "Local recipients of a broadcast package."))
+
+        lines += header("chatmaster_messages_limited_total", "counter", "Messages refused by a rate limit.")
+        lines.append("chatmaster_messages_limited_total %d" % self.messagesLimited)
+
+        lines += header("chatmaster_bytes_sent_total", "counter", "Bytes written to the clients.")
+        lines.append("chatmaster_bytes_sent_total %d" % self.bytesSent)
+        lines += header("chatmaster_bytes_received_total", "counter", "Bytes received from the clients.")
+        lines.append("chatmaster_bytes_received_total %d" % self.bytesReceived)
+        lines += header("chatmaster_writes_total", "counter", "Writes handed to the transports.")
+        lines.append("chatmaster_writes_total %d" % self.writes)
+
+        lines += header("chatmaster_connections_opened_total", "counter", "Connections made.")
+        lines.append("chatmaster_connections_opened_total %d" % self.connectionsOpened)
+        lines += header("chatmaster_connections_closed_total", "counter", "Connections lost.")
+        lines.append("chatmaster_connections_closed_total %d" % self.connectionsClosed)
+        lines += header("chatmaster_connections_reaped_total", "counter", "Connections dropped for not answering a ping.")
+        lines.append("chatmaster_connections_reaped_total %d" % self.connectionsReaped)
+        lines += header("chatmaster_connections", "gauge", "Open connections.")
+        lines.append("chatmaster_connections %d" % len(factory.connections))
+        lines += header("chatmaster_users", "gauge", "Logged in users.")
+        lines.append("chatmaster_users %d" % len(factory.users))
+
+        lines += header("chatmaster_channel_members", "gauge", "Users inside each channel, on this server and on other workers.")
+        channels = sorted(factory.channels.values(), key=lambda channel: channel.name)
+        for channel in channels:
+            lines.append('chatmaster_channel_members{channel="%s",worker="local"} %d' % (escape(channel.name), len(channel.members)))
+            lines.append('chatmaster_channel_members{channel="%s",worker="remote"} %d' % (escape(channel.name), len(channel.remoteMembers)))
+        lines += header("chatmaster_channel_messages_total", "counter", "Messages sent to each channel.")
+        for channel in channels:
+            lines.append('chatmaster_channel_messages_total{channel="%s"} %d' % (escape(channel.name), channel.messages))
+        lines += header("chatmaster_lobby_connections", "gauge", "Connections outside of a channel.")
+        lines.append("chatmaster_lobby_connections %d" % len(factory.lobby))
+
+        return "\n".join(lines) + "\n"
+
+class MetricsResource(Resource):
+    """
+        Serves the metrics of a server over HTTP, for Prometheus to scrape.
+
+        Args:
+            factory (obj)   :   The server factory.
+    """
+
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.factory.metrics.render(self.factory).encode("utf-8")
+
+def header(name, metricType, description):
+    """
+        Returns:
+            The HELP and TYPE lines of a metric.
+    """
+    return ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, metricType)]
+
+def escape(value):
+    """
+        Escapes a label value.
+    """
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
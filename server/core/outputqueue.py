@@ -0,0 +1,105 @@
+from collections import deque
+
+# What to do with a package once a client has fallen too far behind.
+POLICY_DROP         = "drop"
+POLICY_COALESCE     = "coalesce"
+POLICY_DISCONNECT   = "disconnect"
+
+class OutputQueue(object):
+    """
+        The packages waiting for a slow client.
+
+        Packages are only queued while the transport has asked the
+        connection to pause. Every kind of package, as returned by
+        packageKind(), has a policy:
+
+            * drop      :   Once the queue grows past the high watermark,
+                            the oldest packages of this kind are dropped
+                            until it is back under the low watermark.
+            * coalesce  :   A new package replaces the queued one of the
+                            same kind, e.g. an older channel list.
+            * disconnect:   A queue past the high watermark that can not
+                            be brought down by dropping packages is
+                            given up on, and the client disconnected.
+
+        Note:
+            The packages are queued encoded, but not yet compressed or
+            framed, so that dropping one never corrupts the stream.
+
+        Args:
+            highWatermark (int) :   The queued bytes at which the policies
+                                    are applied.
+            lowWatermark (int)  :   The queued bytes dropping stops at.
+            policies (dict)     :   The policy of each kind of package.
+            metrics (obj)       :   The metrics the dropped packages are
+                                    counted in, if any.
+            size (int)          :   The number of queued bytes.
+    """
+
+    highWatermark   = 256 * 1024
+    lowWatermark    = 64 * 1024
+    policies        = {"message": POLICY_DROP, "channel_list": POLICY_COALESCE, "ping": POLICY_COALESCE}
+
+    metrics         = None
+
+    def __init__(self, highWatermark=None, lowWatermark=None, policies=None, metrics=None):
+        if highWatermark is not None:
+            self.highWatermark = highWatermark
+        if lowWatermark is not None:
+            self.lowWatermark = lowWatermark
+        if policies is not None:
+            self.policies = policies
+        if metrics is not None:
+            self.metrics = metrics
+        self.entries = deque()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, kind, payload):
+        """
+            Queues a package.
+
+            Args:
+                kind (str)      :   The kind of package.
+                payload (str)   :   The encoded package.
+
+            Returns:
+                False if the client should be disconnected, otherwise True.
+        """
+        policy = self.policies.get(kind, POLICY_DISCONNECT)
+        if policy == POLICY_COALESCE:
+            self.__remove(lambda entryKind: entryKind == kind)
+        self.entries.append((kind, payload))
+        self.size += len(payload)
+
+        if self.size > self.highWatermark:
+            self.__remove(lambda entryKind: self.policies.get(entryKind) == POLICY_DROP, self.lowWatermark)
+        return self.size <= self.highWatermark
+
+    def pop(self):
+        """
+            Returns:
+                The oldest queued package, or None.
+        """
+        if not self.entries:
+            return None
+        kind, payload = self.entries.popleft()
+        self.size -= len(payload)
+        return payload
+
+    def __remove(self, matches, target=None):
+        """
+            Removes the oldest matching entries, until the queue is
+            down to the target size, or all of them if no target is given.
+        """
+        kept = deque()
+        for kind, payload in self.entries:
+            if (target is None or self.size > target) and matches(kind):
+                self.size -= len(payload)
+                if self.metrics is not None:
+                    self.metrics.didDropPackages(kind)
+            else:
+                kept.append((kind, payload))
+        self.entries = kept
@@ -0,0 +1,167 @@
+class PresenceChanges(object):
+    """
+        The presence changes of a channel not yet sent.
+
+        Args:
+            added (set)     :   The users that joined.
+            removed (set)   :   The users that left.
+            renamed (dict)  :   The new username of every renamed user,
+                                keyed by the username it had when the
+                                changes were last sent.
+            call (obj)      :   The pending flush.
+    """
+
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+        self.renamed = {}
+        self.call = None
+
+    def didJoin(self, username):
+        if username in self.removed:
+            # Left and came back within the same tick.
+            self.removed.discard(username)
+        else:
+            self.added.add(username)
+
+    def didLeave(self, username):
+        if username in self.added:
+            self.added.discard(username)
+            return
+        for oldUsername, newUsername in list(self.renamed.items()):
+            if newUsername == username:
+                del self.renamed[oldUsername]
+                username = oldUsername
+                break
+        self.removed.add(username)
+
+    def didRename(self, oldUsername, newUsername):
+        if oldUsername in self.added:
+            self.added.discard(oldUsername)
+            self.added.add(newUsername)
+            return
+        for previous, current in list(self.renamed.items()):
+            if current == oldUsername:
+                oldUsername = previous
+                break
+        if oldUsername == newUsername:
+            self.renamed.pop(oldUsername, None)
+        else:
+            self.renamed[oldUsername] = newUsername
+
+    def parameters(self, channel):
+        """
+            Returns:
+                The parameters of the presence notification.
+        """
+        renamed = [{"old_username": old, "new_username": new} for old, new in sorted(self.renamed.items())]
+        return {"channel": channel, "added": sorted(self.added), "removed": sorted(self.removed), "renamed": renamed}
+
+    def undo(self, users):
+        """
+            Returns:
+                The users as they were when the changes were last sent.
+        """
+        users = set(users) - self.added
+        for oldUsername, newUsername in self.renamed.items():
+            users.discard(newUsername)
+            users.add(oldUsername)
+        users.update(self.removed)
+        return users
+
+    def isEmpty(self):
+        return not (self.added or self.removed or self.renamed)
+
+class PresenceAggregator(object):
+    """
+        Batches the joins, leaves and renames of every channel.
+
+        Rather than sending the full list of users to the whole channel
+        on every change, which makes a room that N users join at once
+        cost O(N^2), the changes are collected for a short tick and sent
+        as a single "presence" notification holding only the difference.
+        A user that joins and leaves within the same tick is never
+        announced at all.
+
+        Note:
+            A full list of users sent in the middle of a tick must not
+            hold the changes still pending, or the next notification
+            would not apply to it. Use announcedUsers() to build one.
+
+        Args:
+            factory (obj)   :   The server factory, sending the notifications.
+            clock (obj)     :   The clock scheduling the flushes, usually
+                                the reactor.
+            interval (float):   The length of a tick, in seconds.
+            pending (dict)  :   The changes not yet sent, keyed by channel.
+    """
+
+    interval = 0.1
+
+    def __init__(self, factory, clock, interval=None):
+        self.factory = factory
+        self.clock = clock
+        if interval is not None:
+            self.interval = interval
+        self.pending = {}
+
+    def didJoin(self, channel, username):
+        self.__changes(channel).didJoin(username)
+
+    def didLeave(self, channel, username):
+        self.__changes(channel).didLeave(username)
+
+    def didRename(self, channel, oldUsername, newUsername):
+        self.__changes(channel).didRename(oldUsername, newUsername)
+
+    def announcedUsers(self, channel, users):
+        """
+            Returns the users of a channel as of its last presence
+            notification, so that the pending changes apply on top.
+
+            Args:
+                channel (str)   :   The channel.
+                users (list)    :   The users currently inside it.
+        """
+        changes = self.pending.get(channel)
+        if changes is None:
+            return list(users)
+        return sorted(changes.undo(users))
+
+    def discard(self, channel):
+        """
+            Drops the pending changes of a channel, e.g. once it is empty.
+        """
+        changes = self.pending.pop(channel, None)
+        if changes is not None and changes.call.active():
+            changes.call.cancel()
+
+    def flush(self, channel):
+        """
+            Sends the pending changes of a channel.
+
+            Args:
+                channel (str)   :   The channel.
+        """
+        changes = self.pending.pop(channel, None)
+        if changes is None:
+            return
+        if changes.call.active():
+            changes.call.cancel()
+        if not changes.isEmpty():
+            self.factory.sendNotification("presence", channel, changes.parameters(channel))
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __changes(self, channel):
+        """
+            Returns the pending changes of a channel, scheduling a flush
+            at the end of the tick if there were none.
+        """
+        changes = self.pending.get(channel)
+        if changes is None:
+            changes = self.pending[channel] = PresenceChanges()
+            changes.call = self.clock.callLater(self.interval, self.flush, channel)
+        return changes
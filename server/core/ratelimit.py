@@ -0,0 +1,42 @@
+class TokenBucket(object):
+    """
+        A token bucket rate limiter.
+
+        The bucket holds up to burst tokens, and is refilled with rate
+        tokens per second. Every allowed event takes a token. The refill
+        is worked out from the time passed when a token is asked for,
+        so a bucket costs nothing while unused, and no timer is needed.
+
+        Args:
+            rate (float)    :   The tokens added per second.
+            burst (float)   :   The most tokens held at once.
+            tokens (float)  :   The tokens held, as of the last check.
+            last (float)    :   The time of the last check.
+    """
+
+    def __init__(self, rate, burst, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, now, cost=1):
+        """
+            Takes tokens from the bucket, if there are enough.
+
+            Args:
+                now (float) :   The current time, in seconds.
+                cost (int)  :   The number of tokens to take.
+
+            Returns:
+                True if the event is allowed, otherwise False.
+        """
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.last = now
+        if tokens < cost:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - cost
+        return True
@@ -0,0 +1,33 @@
+class Session(object):
+    """
+        The state of a client connection.
+
+        Note:
+            The attributes are slotted rather than kept in the protocol
+            instance, so that an idle connection costs as little memory
+            as possible.
+
+        Args:
+            username (str)      :   The username, once logged in.
+            channel (str)       :   The channel the client is currently in.
+            codec (obj)         :   The codec packages are sent with.
+            compressor (obj)    :   The stream compressor, once negotiated.
+            messageBucket (obj) :   The rate limit of the messages sent.
+            lastActivity (float):   When data was last received.
+            awaitingPong (bool) :   Whether the connection has been pinged
+                                    for being idle.
+            resumeToken (str)   :   The token the session can be resumed
+                                    with, once logged in.
+    """
+
+    __slots__ = ("username", "channel", "codec", "compressor", "messageBucket", "lastActivity", "awaitingPong", "resumeToken")
+
+    def __init__(self, codec):
+        self.username = None
+        self.channel = None
+        self.codec = codec
+        self.compressor = None
+        self.messageBucket = None
+        self.lastActivity = 0.0
+        self.awaitingPong = False
+        self.resumeToken = None
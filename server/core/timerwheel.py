@@ -0,0 +1,89 @@
+class TimerWheel(object):
+    """
+        A hashed timer wheel.
+
+        Items are placed in the slot of the tick they expire at, and a
+        single timer moves the wheel forward one slot per tick, handing
+        the items of the slot to the callback. Scheduling and cancelling
+        are a set operation each, however many items there are, rather
+        than one timer per item.
+
+        Note:
+            A delay longer than the wheel is cut down to one turn of the
+            wheel. The callback is expected to check whether the item is
+            really due, and schedule it again if not.
+
+        Args:
+            clock (obj)     :   The clock driving the wheel, usually the
+                                reactor.
+            callback (func) :   Called with every expired item.
+            interval (float):   The length of a tick, in seconds.
+            size (int)      :   The number of slots.
+            slots (list)    :   The items of each slot.
+            slotOf (dict)   :   The slot of every scheduled item.
+            position (int)  :   The slot of the current tick.
+            call (obj)      :   The timer of the next tick, while any
+                                item is scheduled.
+    """
+
+    interval    = 1.0
+    size        = 128
+
+    def __init__(self, clock, callback, interval=None, size=None):
+        self.clock = clock
+        self.callback = callback
+        if interval is not None:
+            self.interval = interval
+        if size is not None:
+            self.size = size
+        self.slots = [set() for _ in range(self.size)]
+        self.slotOf = {}
+        self.position = 0
+        self.call = None
+
+    def __len__(self):
+        return len(self.slotOf)
+
+    def schedule(self, item, delay):
+        """
+            Schedules an item, replacing an earlier schedule of it.
+
+            Args:
+                item (obj)      :   The item.
+                delay (float)   :   The seconds until it expires.
+        """
+        self.cancel(item)
+        ticks = int(-(-delay // self.interval)) # Rounded up.
+        ticks = min(max(ticks, 1), self.size - 1)
+        slot = (self.position + ticks) % self.size
+        self.slots[slot].add(item)
+        self.slotOf[item] = slot
+        if self.call is None:
+            self.call = self.clock.callLater(self.interval, self.__tick)
+
+    def cancel(self, item):
+        """
+            Removes an item from the wheel, if scheduled.
+        """
+        slot = self.slotOf.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __tick(self):
+        """
+            Moves the wheel one slot forward, and expires its items.
+        """
+        self.call = None
+        self.position = (self.position + 1) % self.size
+        expired = self.slots[self.position]
+        self.slots[self.position] = set()
+        for item in expired:
+            del self.slotOf[item]
+        for item in expired:
+            self.callback(item)
+        if self.slotOf and self.call is None:
+            self.call = self.clock.callLater(self.interval, self.__tick)
@@ -1,8 +1,152 @@
+import argparse, os, signal, socket, sys, tempfile
+# The modules shared by the server and the client live in the shared
+# folder, next to this one.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.endpoints import TCP4ServerEndpoint, UNIXServerEndpoint, UNIXClientEndpoint, connectProtocol
+from twisted.internet.protocol import ProcessProtocol
+from twisted.web.server import Site
 from core.cmserverfactory import CMServerFactory
+from core.bus import BusHub, BusClient
+from core.messagelog import MessageLog, SYNC_ALWAYS, SYNC_INTERVAL, SYNC_NEVER
+from core.metrics import MetricsResource
+
+# The length of the queue of connections not yet accepted. A login storm
+# overflowing it leaves clients believing they are connected, while the
+# server has dropped them.
+BACKLOG = 1024
+
+def listenReusingPort(port, factory):
+    """
+        Listens on a port shared with the other workers.
+
+        Note:
+            With SO_REUSEPORT set, the kernel spreads the incoming
+            connections over every process listening on the port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    sock.listen(BACKLOG)
+    sock.setblocking(False)
+    listeningPort = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    # The reactor works on a copy of the file descriptor.
+    sock.close()
+    return listeningPort
+
+def listenMetrics(port, factory):
+    """
+        Serves the metrics of a server on a local port.
+    """
+    if port is not None:
+        reactor.listenTCP(port, Site(MetricsResource(factory)), interface="127.0.0.1")
+
+def setRateLimits(messageRate, channelMessageRate):
+    """
+        Sets the message rate limits of every server factory, allowing
+        bursts of twice the rate. A rate of 0 turns the limit off.
+    """
+    CMServerFactory.messageRate = messageRate or None
+    CMServerFactory.messageBurst = max(1, int(messageRate * 2))
+    CMServerFactory.channelMessageRate = channelMessageRate or None
+    CMServerFactory.channelMessageBurst = max(1, int(channelMessageRate * 2))
+
+def stopReactor(*args):
+    """
+        Stops the reactor, unless it is already shutting down.
+    """
+    try:
+        reactor.stop()
+    except ReactorNotRunning:
+        pass
+
+def runWorker(port, busPath, metricsPort=None):
+    """
+        Runs a worker process, which starts accepting connections once
+        it has joined the room bus, and stops when the bus goes away.
+    """
+    factory = CMServerFactory()
+    listenMetrics(metricsPort, factory)
+    bus = BusClient(factory, os.getpid())
+    bus.onConnectionLost = stopReactor
+    deferred = connectProtocol(UNIXClientEndpoint(reactor, busPath), bus)
+    deferred.addCallback(lambda _: listenReusingPort(port, factory))
+    deferred.addErrback(stopReactor)
+
+def runMaster(port, workers, metricsPort=None):
+    """
+        Runs the room bus hub, and spawns the worker processes.
+
+        Note:
+            The workers are not signalled on shutdown. They stop by
+            themselves as soon as the hub goes away. Every worker
+            serves its own metrics, on consecutive ports.
+    """
+    busPath = os.path.join(tempfile.mkdtemp(), "bus.sock")
+
+    def spawnWorkers(_):
+        arguments = [sys.executable, os.path.abspath(__file__), "--port", str(port), "--bus", busPath,
+            "--message-rate", str(CMServerFactory.messageRate or 0),
+            "--channel-message-rate", str(CMServerFactory.channelMessageRate or 0)]
+        if CMServerFactory.flushInterval is not None:
+            arguments += ["--flush-interval", str(CMServerFactory.flushInterval)]
+        for worker in range(workers):
+            workerArguments = arguments[:]
+            if metricsPort is not None:
+                workerArguments += ["--metrics-port", str(metricsPort + worker)]
+            reactor.spawnProcess(ProcessProtocol(), sys.executable, workerArguments, env=os.environ, childFDs={0: 0, 1: 1, 2: 2})
+
+    UNIXServerEndpoint(reactor, busPath).listen(BusHub()).addCallback(spawnWorkers)
 
 if __name__ == "__main__":
-    endpoint = TCP4ServerEndpoint(reactor, 9000)
-    endpoint.listen(CMServerFactory())
-    reactor.run()
+    parser = argparse.ArgumentParser(description="The ChatMaster 3000 server.")
+    parser.add_argument("--port", type=int, default=9000, help="the port to listen on")
+    parser.add_argument("--workers", type=int, default=1, help="the number of worker processes")
+    parser.add_argument("--log-dir", help="keep a durable log of the messages in this directory")
+    parser.add_argument("--sync", choices=[SYNC_ALWAYS, SYNC_INTERVAL, SYNC_NEVER], default=SYNC_INTERVAL, help="when to fsync the message log")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics over HTTP on this local port")
+    parser.add_argument("--message-rate", type=float, default=CMServerFactory.messageRate, help="the messages per second a user may send, 0 for no limit")
+    parser.add_argument("--channel-message-rate", type=float, default=CMServerFactory.channelMessageRate, help="the messages per second routed to a channel, 0 for no limit")
+    parser.add_argument("--flush-interval", type=float, help="batch the writes to each client, holding them back for up to this many seconds, 0 for one reactor tick")
+    parser.add_argument("--loop", choices=["twisted", "asyncio", "uvloop"], default="twisted", help="the event loop to run on")
+    parser.add_argument("--bus", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.log_dir is not None and arguments.workers > 1:
+        parser.error("--log-dir can not be combined with --workers")
+    if arguments.loop != "twisted":
+        if sys.version_info < (3, 4):
+            parser.error("--loop %s requires Python 3" % arguments.loop)
+        if arguments.workers > 1 or arguments.log_dir is not None:
+            parser.error("--loop %s can not be combined with --workers or --log-dir" % arguments.loop)
+        if arguments.loop == "uvloop":
+            try:
+                import uvloop
+            except ImportError:
+                parser.error("--loop uvloop requires the uvloop library")
+
+    setRateLimits(arguments.message_rate, arguments.channel_message_rate)
+    CMServerFactory.flushInterval = arguments.flush_interval
+    if arguments.loop != "twisted":
+        from core.aioserver import runAsyncio
+        runAsyncio(arguments.port, arguments.loop, BACKLOG, arguments.metrics_port)
+    elif arguments.bus is not None:
+        # A Ctrl-C reaches the whole process group. Workers leave it to
+        # the master, and stop when the bus goes away.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        runWorker(arguments.port, arguments.bus, arguments.metrics_port)
+        reactor.run(installSignalHandlers=False)
+    else:
+        if arguments.workers > 1:
+            runMaster(arguments.port, arguments.workers, arguments.metrics_port)
+        else:
+            messageLog = None
+            if arguments.log_dir is not None:
+                messageLog = MessageLog(arguments.log_dir, syncPolicy=arguments.sync)
+                reactor.addSystemEventTrigger("before", "shutdown", messageLog.close)
+            factory = CMServerFactory(messageLog)
+            listenMetrics(arguments.metrics_port, factory)
+            endpoint = TCP4ServerEndpoint(reactor, arguments.port, backlog=BACKLOG)
+            endpoint.listen(factory)
+        reactor.run()
@@ -0,0 +1,44 @@
+def newPackage(packageType, data):
+    """
+        Returns a package.
+
+        Args:
+            packageType (str)   :   The package type.
+            data (dict)         :   The data attribute of the package.
+    """
+    return {
+        "type": packageType,
+        "data": data
+    }
+
+def newMessage(message, username):
+    """
+        Returns a message package.
+
+        Args:
+            message (str)   :   The message.
+            username (str)  :   The user that sent the message.
+    """
+    return newPackage("message", {"message": message, "username": username})
+
+def newNotification(event_type, parameters=[]):
+    """
+        Returns a notification package.
+
+        Args:
+            event_type (str)    :   The event type.
+            parameters (dict)   :   The event parameters.
+    """
+    return newPackage("notification", {"event_type": event_type, "parameters": parameters})
+
+def packageKind(package):
+    """
+        Returns the kind of a package, which is its type, or for
+        notifications its event type.
+
+        Args:
+            package (dict)  :   The package.
+    """
+    if package["type"] == "notification":
+        return package["data"]["event_type"]
+    return package["type"]
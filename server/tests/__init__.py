@@ -0,0 +1,4 @@
+import os, sys
+# The modules shared by the server and the client live in the shared
+# folder, next to the server folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -0,0 +1,72 @@
+import json, unittest
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from core.cmserverfactory import CMServerFactory
+
+def command(name, parameters):
+    return json.dumps({"type": "command", "data": {"command": name, "parameters": parameters}}).encode("utf-8") + b"\n"
+
+class CMServerTestCase(unittest.TestCase):
+    """
+        Drives server connections over string transports.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = CMServerFactory(clock=self.clock)
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        transport.clear()
+        return protocol, transport
+
+    def send(self, protocol, transport, name, parameters):
+        protocol.dataReceived(command(name, parameters))
+        self.clock.advance(1)
+        packages = [json.loads(line) for line in transport.value().decode("utf-8").splitlines() if line]
+        transport.clear()
+        return packages
+
+    def errors(self, packages):
+        return [package["data"] for package in packages if package["type"] == "error"]
+
+    def login(self, username):
+        protocol, transport = self.connect()
+        packages = self.send(protocol, transport, "login", {"username": username})
+        self.assertEqual(self.errors(packages), [])
+        return protocol, transport
+
+    def testMistypedChannelIsRefused(self):
+        protocol, transport = self.login("alice")
+        for channel in ({"a": 1}, ["x"], 1):
+            packages = self.send(protocol, transport, "join", {"channel": channel})
+            self.assertEqual(len(self.errors(packages)), 1)
+            self.assertIsNone(protocol.session.channel)
+
+    def testMistypedUsernameIsRefused(self):
+        protocol, transport = self.connect()
+        packages = self.send(protocol, transport, "login", {"username": ["alice"]})
+        self.assertEqual(len(self.errors(packages)), 1)
+        protocol, transport = self.login("alice")
+        packages = self.send(protocol, transport, "rename", {"username": {"a": 1}})
+        self.assertEqual(len(self.errors(packages)), 1)
+        self.assertEqual(protocol.session.username, "alice")
+
+    def testRepeatedLoginKeepsFraming(self):
+        protocol, transport = self.login("alice")
+        packages = self.send(protocol, transport, "login", {"username": "bob", "framing": ["length"]})
+        self.assertEqual(len(self.errors(packages)), 1)
+        packages = self.send(protocol, transport, "users", {})
+        self.assertEqual(len(self.errors(packages)), 1)
+
+    def testUsernameIsReleasedAfterMistypedJoin(self):
+        protocol, transport = self.login("alice")
+        self.send(protocol, transport, "join", {"channel": {"a": 1}})
+        protocol.connectionLost(None)
+        self.assertNotIn(protocol, self.factory.connections)
+        self.login("alice")
+
+if __name__ == "__main__":
+    unittest.main()
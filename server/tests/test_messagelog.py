@@ -0,0 +1,42 @@
+import os, shutil, tempfile, unittest
+from core.messagelog import ChannelLog, INDEX_RECORD
+
+class ChannelLogTestCase(unittest.TestCase):
+    """
+        Recovers channel logs left behind by a crash.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, payloads):
+        channelLog = ChannelLog(self.directory)
+        for payload in payloads:
+            channelLog.append(0.0, payload, 1024)
+        channelLog.close()
+        return channelLog.segments[-1]
+
+    def testIndexAheadOfLogIsDropped(self):
+        segment = self.write([b"one", b"two", b"three"])
+        with open(segment.logPath, "r+b") as f:
+            f.truncate(4)
+        channelLog = ChannelLog(self.directory)
+        channelLog.append(0.0, b"four", 1024)
+        channelLog.close()
+        self.assertEqual(channelLog.last(10), [b"one", b"four"])
+        self.assertEqual(os.path.getsize(segment.logPath), 7)
+
+    def testHalfWrittenRecordIsDropped(self):
+        segment = self.write([b"one", b"two"])
+        with open(segment.indexPath, "ab") as f:
+            f.write(b"\0" * (INDEX_RECORD.size // 2))
+        channelLog = ChannelLog(self.directory)
+        channelLog.append(0.0, b"three", 1024)
+        channelLog.close()
+        self.assertEqual(channelLog.last(10), [b"one", b"two", b"three"])
+
+if __name__ == "__main__":
+    unittest.main()
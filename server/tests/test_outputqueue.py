@@ -0,0 +1,27 @@
+import unittest
+from core.metrics import Metrics
+from core.outputqueue import OutputQueue
+
+class OutputQueueTestCase(unittest.TestCase):
+    """
+        Applies the policies of a queue for a slow client.
+    """
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.queue = OutputQueue(100, 50, metrics=self.metrics)
+
+    def testDroppedPackagesAreCounted(self):
+        for _ in range(11):
+            self.assertTrue(self.queue.push("message", b"x" * 10))
+        self.assertEqual(self.queue.size, 50)
+        self.assertEqual(self.metrics.packagesDropped, {"message": 6})
+
+    def testCoalescedPackagesAreCounted(self):
+        self.queue.push("channel_list", b"old")
+        self.queue.push("channel_list", b"new")
+        self.assertEqual(self.queue.pop(), b"new")
+        self.assertEqual(self.metrics.packagesDropped, {"channel_list": 1})
+
+if __name__ == "__main__":
+    unittest.main()
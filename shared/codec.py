@@ -0,0 +1,183 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    integerTypes = (int, long)
+except NameError:
+    integerTypes = (int,)
+
+# The available codecs. JSON is the default, and is what both sides
+# speak until something else has been negotiated. The binary codec
+# needs the optional msgpack library, and is only offered with it.
+CODEC_JSON      = "json"
+CODEC_BINARY    = "binary"
+CODEC_NAMES     = [CODEC_BINARY, CODEC_JSON] if msgpack is not None else [CODEC_JSON]
+
+# The small integer tags of the binary codec. New names must only ever
+# be appended, as the position of a name is its tag.
+PACKAGE_TYPES   = ["message", "command", "request", "notification", "session", "error", "ping", "pong"]
+COMMANDS        = ["login", "rename", "join", "leave", "private", "public", "channels", "channel_list", "history", "users"]
+EVENT_TYPES     = ["channel_list", "user_list", "presence", "user_rename", "channel_visibility", "resume"]
+
+class CodecError(ValueError):
+    """
+        Raised when a payload can not be decoded.
+    """
+    pass
+
+class JSONCodec(object):
+    """
+        Encodes packages as JSON text.
+    """
+
+    name = CODEC_JSON
+
+    def encode(self, package):
+        payload = json.dumps(package)
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf-8")
+        return payload
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+class BinaryCodec(object):
+    """
+        Encodes packages in MessagePack.
+
+        A package is encoded as a two element array, holding the tag of
+        its type and its data, where the command of a command package
+        and the event type of a notification are replaced by their tags
+        too. Names without a tag are kept as strings, so that the tag
+        tables only need to cover the common packages. Anything else,
+        or data that is not an object or null, is refused when decoded.
+
+        Note:
+            The codec needs the msgpack library. Binary payloads may
+            contain newlines, and are only offered on length prefixed
+            connections.
+    """
+
+    name = CODEC_BINARY
+
+    def __init__(self):
+        self.typeTags = dict((name, tag) for tag, name in enumerate(PACKAGE_TYPES))
+        self.commandTags = dict((name, tag) for tag, name in enumerate(COMMANDS))
+        self.eventTags = dict((name, tag) for tag, name in enumerate(EVENT_TYPES))
+
+    def encode(self, package):
+        """
+            Encodes a package.
+
+            Args:
+                package (dict)  :   The package.
+
+            Returns:
+                The encoded package.
+        """
+        packageType = package.get("type")
+        data = package.get("data")
+        if packageType == "command" and data and data.get("command") in self.commandTags:
+            data = dict(data)
+            data["command"] = self.commandTags[data["command"]]
+        elif packageType == "notification" and data and data.get("event_type") in self.eventTags:
+            data = dict(data)
+            data["event_type"] = self.eventTags[data["event_type"]]
+        body = [self.typeTags.get(packageType, packageType), data]
+        return msgpack.packb(body, use_bin_type=False)
+
+    def decode(self, payload):
+        """
+            Decodes a package.
+
+            Args:
+                payload (str)   :   The encoded package.
+
+            Returns:
+                The package.
+
+            Raises:
+                CodecError, if the payload is not a well formed package,
+                or if msgpack is not installed.
+        """
+        if msgpack is None:
+            raise CodecError("The binary codec requires msgpack.")
+        try:
+            body = msgpack.unpackb(payload, raw=False)
+        except Exception as error:
+            raise CodecError(str(error))
+        if not isinstance(body, list) or len(body) != 2:
+            raise CodecError("Malformed package.")
+        packageType, data = body
+        if data is not None and not isinstance(data, dict):
+            raise CodecError("Malformed package.")
+        if isinstance(packageType, integerTypes):
+            packageType = tagName(PACKAGE_TYPES, packageType)
+        if isinstance(data, dict):
+            if packageType == "command" and isinstance(data.get("command"), integerTypes):
+                data["command"] = tagName(COMMANDS, data["command"])
+            elif packageType == "notification" and isinstance(data.get("event_type"), integerTypes):
+                data["event_type"] = tagName(EVENT_TYPES, data["event_type"])
+        return {"type": packageType, "data": data}
+
+CODECS = {
+    CODEC_JSON: JSONCodec(),
+    CODEC_BINARY: BinaryCodec()
+}
+
+def getCodec(name=CODEC_JSON):
+    """
+        Returns:
+            The codec with the given name.
+    """
+    return CODECS[name]
+
+def decodePackage(payload):
+    """
+        Decodes a package, whatever codec it was encoded with.
+
+        Note:
+            A JSON package always starts with a brace, which in
+            MessagePack would be a bare integer, never a package. This
+            makes it safe to switch codec at any point of the stream.
+
+        Args:
+            payload (str)   :   The encoded package.
+
+        Returns:
+            The package.
+    """
+    if payload[:1] in (b"{", "{"):
+        return CODECS[CODEC_JSON].decode(payload)
+    return CODECS[CODEC_BINARY].decode(payload)
+
+def negotiateCodec(offered, supported=CODEC_NAMES):
+    """
+        Picks a codec.
+
+        Args:
+            offered (list)      :   The codecs offered, in order of preference.
+            supported (list)    :   The codecs supported by this side.
+
+        Returns:
+            The first offered codec that is supported, falling back to JSON.
+    """
+    if isinstance(offered, list):
+        for name in offered:
+            if name in supported:
+                return name
+    elif offered in supported:
+        return offered
+    return CODEC_JSON
+
+def tagName(names, tag):
+    """
+        Returns the name of a tag, or the tag itself if it is unknown.
+    """
+    if 0 <= tag < len(names):
+        return names[tag]
+    return tag
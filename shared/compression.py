@@ -0,0 +1,117 @@
+import zlib
+
+# The available compression methods.
+COMPRESSION_ZLIB    = "zlib"
+COMPRESSION_METHODS = [COMPRESSION_ZLIB]
+
+# Every frame on a compressed connection starts with a flag byte,
+# telling whether the rest of the frame is compressed or not.
+FLAG_RAW    = b"\x00"
+FLAG_ZLIB   = b"\x01"
+
+class CompressionError(Exception):
+    """
+        Raised when a compressed frame can not be decompressed.
+    """
+    pass
+
+class StreamCompressor(object):
+    """
+        A per-connection, streaming zlib compressor.
+
+        All frames sent over a connection are compressed as one zlib
+        stream, flushed at the end of every frame. This way, the keys
+        repeated in every package, such as "type", "data" and "username",
+        are found in the shared history rather than compressed again
+        from scratch.
+
+        Note:
+            Frames shorter than the threshold are sent uncompressed, as
+            they would barely shrink. Compressed frames must therefore
+            be length prefixed, as they may contain newlines.
+
+        Args:
+            threshold (int) :   The smallest payload that is compressed.
+            level (int)     :   The zlib compression level.
+            maxPayloadSize (int):   The largest decompressed payload
+                                    accepted, in bytes.
+    """
+
+    threshold       = 256
+    level           = 6
+    maxPayloadSize  = 1024 * 1024
+
+    def __init__(self, threshold=None, level=None, maxPayloadSize=None):
+        if threshold is not None:
+            self.threshold = threshold
+        if level is not None:
+            self.level = level
+        if maxPayloadSize is not None:
+            self.maxPayloadSize = maxPayloadSize
+        self.compressor = zlib.compressobj(self.level)
+        self.decompressor = zlib.decompressobj()
+
+    def compress(self, payload):
+        """
+            Compresses an outgoing payload.
+
+            Args:
+                payload (str)   :   The payload to compress.
+
+            Returns:
+                The flagged, and possibly compressed, payload.
+        """
+        if len(payload) < self.threshold:
+            return FLAG_RAW + payload
+        data = self.compressor.compress(payload)
+        return FLAG_ZLIB + data + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, frame):
+        """
+            Decompresses an incoming frame.
+
+            Note:
+                The output is bounded by maxPayloadSize, so that a small
+                frame can not inflate into a huge payload.
+
+            Args:
+                frame (str) :   The flagged frame.
+
+            Returns:
+                The payload.
+
+            Raises:
+                CompressionError, if the frame can not be decompressed,
+                or inflates to more than maxPayloadSize bytes.
+        """
+        flag = frame[:1]
+        if flag == FLAG_RAW:
+            return frame[1:]
+        if flag == FLAG_ZLIB:
+            try:
+                payload = self.decompressor.decompress(frame[1:], self.maxPayloadSize + 1)
+            except zlib.error as error:
+                raise CompressionError(str(error))
+            if self.decompressor.unconsumed_tail or len(payload) > self.maxPayloadSize:
+                raise CompressionError("Payload exceeds %d bytes." % self.maxPayloadSize)
+            return payload
+        raise CompressionError("Unknown compression flag.")
+
+def negotiateCompression(offered, supported=COMPRESSION_METHODS):
+    """
+        Picks a compression method.
+
+        Args:
+            offered (list)      :   The methods offered, in order of preference.
+            supported (list)    :   The methods supported by this side.
+
+        Returns:
+            The first offered method that is supported, or None.
+    """
+    if isinstance(offered, list):
+        for method in offered:
+            if method in supported:
+                return method
+    elif offered in supported:
+        return offered
+    return None
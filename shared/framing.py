@@ -0,0 +1,210 @@
+import struct
+
+# The available framing modes. Newline framing is the default, and is
+# what both sides speak until something else has been negotiated.
+FRAMING_NEWLINE = "newline"
+FRAMING_LENGTH  = "length"
+FRAMING_MODES   = [FRAMING_LENGTH, FRAMING_NEWLINE]
+
+# Length prefixed frames start with an unsigned 32 bit, big endian integer.
+LENGTH_PREFIX = struct.Struct("!I")
+
+class FramingError(Exception):
+    """
+        Raised when the incoming stream can not be split into frames,
+        for instance when a frame exceeds the maximum frame size.
+    """
+    pass
+
+class FrameBuffer(object):
+    """
+        An incremental frame buffer.
+
+        TCP is a stream, so a single call to dataReceived() may contain
+        several packages, or only a part of one. The frame buffer collects
+        the chunks and hands out complete frames, one at a time.
+
+        Note:
+            Consumed bytes are not removed from the buffer right away.
+            Instead, a read offset is moved forward, and the buffer is
+            compacted only when more than half of it has been consumed.
+            In newline mode the position of the last scan is remembered,
+            so that the same bytes are never searched twice.
+
+        Args:
+            mode (str)          :   The current framing mode.
+            maxFrameSize (int)  :   The largest frame accepted, in bytes.
+    """
+
+    mode            = FRAMING_NEWLINE
+    maxFrameSize    = 1024 * 1024
+
+    def __init__(self, mode=FRAMING_NEWLINE, maxFrameSize=None):
+        self.setMode(mode)
+        if maxFrameSize is not None:
+            self.maxFrameSize = maxFrameSize
+        self.buffer = bytearray()
+        self.offset = 0
+        self.scanned = 0
+
+    def setMode(self, mode):
+        """
+            Sets the framing mode.
+
+            Note:
+                The new mode applies to the first frame not yet handed
+                out, which makes it safe to switch mode in the middle of
+                a chunk, right after the negotiating package.
+
+            Args:
+                mode (str)  :   The new framing mode.
+        """
+        if mode not in FRAMING_MODES:
+            raise FramingError("Unknown framing mode %s." % mode)
+        self.mode = mode
+
+    def feed(self, data):
+        """
+            Adds a chunk of received data to the buffer.
+
+            Args:
+                data (str)  :   The data received.
+        """
+        self.buffer.extend(data)
+
+    def pending(self):
+        """
+            Returns:
+                The number of buffered bytes not yet handed out.
+        """
+        return len(self.buffer) - self.offset
+
+    def nextFrame(self):
+        """
+            Extracts the next complete frame.
+
+            Returns:
+                The frame, without its delimiter or prefix, or None if
+                the buffer does not yet hold a complete frame.
+        """
+        if self.mode == FRAMING_LENGTH:
+            frame = self.__nextLengthFrame()
+        else:
+            frame = self.__nextNewlineFrame()
+        self.__compact()
+        return frame
+
+    def frames(self):
+        """
+            Iterates over the complete frames in the buffer.
+        """
+        while True:
+            frame = self.nextFrame()
+            if frame is None:
+                break
+            yield frame
+
+    def encode(self, payload):
+        """
+            Frames an outgoing payload in the current mode.
+
+            Args:
+                payload (str)   :   The payload to frame.
+
+            Returns:
+                The framed payload, ready to be written to the transport.
+        """
+        return encodeFrame(payload, self.mode)
+
+    ##########################
+    #   Semi-private methods
+    ##########################
+
+    def __nextNewlineFrame(self):
+        """
+            Extracts the next newline delimited frame.
+        """
+        start = max(self.offset, self.scanned)
+        index = self.buffer.find(b"\n", start)
+        if index < 0:
+            self.scanned = len(self.buffer)
+            if self.scanned - self.offset > self.maxFrameSize:
+                raise FramingError("Frame exceeds %d bytes." % self.maxFrameSize)
+            return None
+
+        frame = bytes(self.buffer[self.offset:index])
+        self.offset = index + 1
+        self.scanned = self.offset
+        return frame
+
+    def __nextLengthFrame(self):
+        """
+            Extracts the next length prefixed frame.
+        """
+        available = len(self.buffer) - self.offset
+        if available < LENGTH_PREFIX.size:
+            return None
+
+        length, = LENGTH_PREFIX.unpack_from(self.buffer, self.offset)
+        if length > self.maxFrameSize:
+            raise FramingError("Frame exceeds %d bytes." % self.maxFrameSize)
+        if available < LENGTH_PREFIX.size + length:
+            return None
+
+        start = self.offset + LENGTH_PREFIX.size
+        frame = bytes(self.buffer[start:start + length])
+        self.offset = start + length
+        self.scanned = self.offset
+        return frame
+
+    def __compact(self):
+        """
+            Drops the consumed part of the buffer, once it makes up more
+            than half of it. This keeps the cost of compacting linear in
+            the amount of data received.
+        """
+        if self.offset == 0:
+            return
+        if self.offset == len(self.buffer):
+            self.buffer = bytearray()
+        elif self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+        else:
+            return
+        self.scanned -= self.offset
+        self.offset = 0
+
+def encodeFrame(payload, mode=FRAMING_NEWLINE):
+    """
+        Frames a payload.
+
+        Args:
+            payload (str)   :   The payload to frame.
+            mode (str)      :   The framing mode.
+
+        Returns:
+            The framed payload.
+    """
+    if mode == FRAMING_LENGTH:
+        return LENGTH_PREFIX.pack(len(payload)) + payload
+    return payload + b"\n"
+
+def negotiateFraming(offered, supported=FRAMING_MODES):
+    """
+        Picks a framing mode.
+
+        Args:
+            offered (list)      :   The modes offered, in order of preference.
+            supported (list)    :   The modes supported by this side.
+
+        Returns:
+            The first offered mode that is supported, falling back to
+            newline framing.
+    """
+    if isinstance(offered, list):
+        for mode in offered:
+            if mode in supported:
+                return mode
+    elif offered in supported:
+        return offered
+    return FRAMING_NEWLINE